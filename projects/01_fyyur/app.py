@@ -3,9 +3,8 @@
 #----------------------------------------------------------------------------#
 
 import json
+import os
 import dateutil.parser
-import babel
-import re
 from flask import (Flask,
                   render_template,
                   request,
@@ -24,6 +23,9 @@ from forms import *
 import sys
 from flask_migrate import Migrate
 from datetime import datetime
+from itertools import groupby
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
 
 #----------------------------------------------------------------------------#
 # App Config.
@@ -35,31 +37,60 @@ moment = Moment(app)
 app.config.from_object('config')
 app.config['SQLALCHEMY_ECHO'] = False
 
-# Connect to local postgresql database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres://postgres@localhost:5432/fyyur'
+# Connect to local postgresql database, unless DATABASE_URL names another
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'postgres://postgres@localhost:5432/fyyur')
 
 # Import models
-from models import db, Venue, Artist, Show
-
-# Initialize SQLAlchemy with current app
+from models import db, Venue, Artist, Show, Genre, VenueGenre, ArtistGenre
+from search import search
+from cache import PageCache
+from formatting import format_datetime
+from instrumentation import Instrumentation
+from pool import engine_options, pool_health
+
+# Initialize SQLAlchemy with current app, with the pool settings of its config
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config, app.config['SQLALCHEMY_DATABASE_URI'])
 db.init_app(app)
 
 # Instantiate migration object
 migrate = Migrate(app, db)
 
+# Register bulk import and export commands under `flask data`
+from bulk import data_cli
+app.cli.add_command(data_cli)
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-  date = dateutil.parser.parse(value)
-  if format == 'full':
-      format="EEEE MMMM, d, y 'at' h:mma"
-  elif format == 'medium':
-      format="EE MM, dd, y h:mma"
-  return babel.dates.format_datetime(date, format)
+def datetime_filter(value, format='medium'):
+  return format_datetime(value, format, app.config['DATETIME_LOCALE'])
 
-app.jinja_env.filters['datetime'] = format_datetime
+app.jinja_env.filters['datetime'] = datetime_filter
+
+#----------------------------------------------------------------------------#
+# Page cache.
+#----------------------------------------------------------------------------#
+
+page_cache = PageCache.from_config(app.config)
+# Found there by commands that change what pages show, such as `flask data import`
+app.extensions['page_cache'] = page_cache
+
+# Records per-endpoint latency, SQL and template timings when
+# INSTRUMENTATION_ENABLED is set
+instrumentation = Instrumentation(app)
+
+def venue_pages(venue_id):
+  # Keys of the cached pages showing a venue: the venue directory, the
+  # venue's own page and the pages of artists with shows there
+  artist_ids = db.session.query(Show.artist_id).filter(Show.venue_id == venue_id).distinct()
+  return ['venues', 'venue:{}'.format(venue_id)] + ['artist:{}'.format(artist_id) for (artist_id,) in artist_ids]
+
+def artist_pages(artist_id):
+  # Keys of the cached pages showing an artist: the artist directory, the
+  # artist's own page and the pages of venues the artist has played
+  venue_ids = db.session.query(Show.venue_id).filter(Show.artist_id == artist_id).distinct()
+  return ['artists', 'artist:{}'.format(artist_id)] + ['venue:{}'.format(venue_id) for (venue_id,) in venue_ids]
 
 #----------------------------------------------------------------------------#
 # Controllers.
@@ -73,90 +104,83 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@page_cache.cached('venues')
 def venues():
+  # Count each venue's upcoming shows in a correlated subquery so that the
+  # whole directory is fetched in a single round trip
+  num_upcoming_shows = Show.count_upcoming(Venue, datetime.now())
+  # Order by area so that venues in the same city and state are adjacent
+  local_venues = db.session.query(
+    Venue.city,
+    Venue.state,
+    Venue.id,
+    Venue.name,
+    num_upcoming_shows.label('num_upcoming_shows')
+  ).order_by(Venue.state, Venue.city, Venue.name).all()
   data = []
-  cities = []
-  venues = db.session.query(Venue).all()
-  shows = db.session.query(Show).all()
-  for venue in venues:
-    current_venue = Venue.query.get(venue.id)
-    city = current_venue.city
-    if city in cities:
-      pass
-    else:
-      state = current_venue.state
-      local_venues_list = []
-      all_local_venues = Venue.query.filter_by(city=city).all()
-      for local_venue in all_local_venues:
-        local_venues_list.append(
+  for (city, state), area_venues in groupby(local_venues, key=lambda venue: (venue.city, venue.state)):
+    data.append(
+      {
+        "city": city,
+        "state": state,
+        "venues": [
           {
-            "id": local_venue.id,
-            "name": local_venue.name,
-            "num_upcoming_shows": Show.query.filter_by(venue_id=local_venue.id).count()
+            "id": venue.id,
+            "name": venue.name,
+            "num_upcoming_shows": venue.num_upcoming_shows
           }
-        )
-      data.append(
-        {
-          "city": city,
-          "state": state,
-          "venues": local_venues_list
-        }
-      )
-      cities.append(city)
+          for venue in area_venues
+        ]
+      }
+    )
   return render_template('pages/venues.html', areas = data)
 
 @app.route('/venues/search', methods = ['POST'])
 def search_venues():
   search_term = request.get_json()['search_term']
-  matches = Venue.query.filter(Venue.name.ilike('%' + search_term + '%')).all()
-  match_count = len(matches)
+  try:
+    limit = min(int(request.get_json().get('limit', app.config['SEARCH_RESULTS_LIMIT'])), app.config['SEARCH_RESULTS_MAX_LIMIT'])
+    matches, next_cursor = search(Venue, search_term, limit, request.get_json().get('cursor'))
+  except ValueError:
+    abort(400)
   match_details = []
   for match in matches:
-    current_time = datetime.now()
-    upcoming_shows = []
-    shows = match.shows
-    for show in shows:
-      show_datetime = datetime.strptime(show.start_time, '%Y-%m-%d %H:%M:%S')
-      if show_datetime > current_time:
-        upcoming_shows.append(show)
-    count_upcoming_shows = len(upcoming_shows)
     match_details.append({
       'id': match.id,
       'name': match.name,
-      'num_upcoming_shows': count_upcoming_shows
+      'num_upcoming_shows': match.num_upcoming_shows
     })
   response = {
-    'count': match_count,
-    'data': match_details
+    'count': len(match_details),
+    'data': match_details,
+    'next_cursor': next_cursor
   }
   return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/venues/<int:venue_id>')
+@page_cache.cached('venue:{venue_id}')
 def show_venue(venue_id):
   # Shows the venue page with the given venue_id
-  data = Venue.query.get(venue_id)
-  print(data)
-  # Split into multiple discrete genres using a delimiter
-  genres_concatenated = data.genres
-  data.genres = re.split(',', genres_concatenated)
-  # Append data on past and upcoming shows
-  # shows = Show.query.filter_by(venue_id=venue_id).all()
-  num_upcoming_shows = 0
-  upcoming_shows = []
-  past_shows = []
-  current_time = datetime.now()
-  for show in data.shows:
-    show.artist_image_link = show.artist.image_link
-    show.artist_name = show.artist.name
-    show_datetime = datetime.strptime(show.start_time, '%Y-%m-%d %H:%M:%S')
-    if show_datetime > current_time:
-      num_upcoming_shows += 1
-      upcoming_shows.append(show)
-    elif show_datetime <= current_time:
-      past_shows.append(show)
+  # Load the venue's genres in the same query as the venue itself
+  data = Venue.query.options(joinedload(Venue.genres)).get(venue_id)
+  # Fetch every show with its artist's details in one joined projection,
+  # letting the database flag which shows are upcoming
+  shows = db.session.query(
+    Show.id,
+    Show.artist_id,
+    Artist.name.label('artist_name'),
+    Artist.image_link.label('artist_image_link'),
+    Show.start_time,
+    (Show.start_time > datetime.now()).label('upcoming')
+  ).join(Artist, Show.artist_id == Artist.id).filter(
+    Show.venue_id == venue_id
+  ).order_by(Show.start_time).all()
+  upcoming_shows = [show for show in shows if show.upcoming]
+  past_shows = [show for show in reversed(shows) if not show.upcoming]
   data.past_shows = past_shows
+  data.past_shows_count = len(past_shows)
   data.upcoming_shows = upcoming_shows
-  data.upcoming_shows_count = num_upcoming_shows
+  data.upcoming_shows_count = len(upcoming_shows)
   return render_template('pages/show_venue.html', venue=data)
 
 #  Create Venue
@@ -179,7 +203,7 @@ def create_venue_submission():
     venue_phone = request.get_json()['phone']
     venue_genres = request.get_json()['genres']
     venue_facebook_link = request.get_json()['facebook_link']
-    new_venue = Venue(name = venue_name, city = venue_city, state = venue_state, address = venue_address, phone = venue_phone, genres = venue_genres, facebook_link = venue_facebook_link)
+    new_venue = Venue(name = venue_name, city = venue_city, state = venue_state, address = venue_address, phone = venue_phone, genres = Genre.from_names(venue_genres), facebook_link = venue_facebook_link)
     # Add new venue record to db
     db.session.add(new_venue)
     db.session.commit()
@@ -192,6 +216,7 @@ def create_venue_submission():
   if error:
     abort(400)
   else:
+    page_cache.invalidate('venues')
     flash('Venue ' + venue_name + ' was successfully listed!')
     return render_template('pages/home.html')
 
@@ -201,6 +226,8 @@ def delete_venue(venue_id):
   body = {}
   try:
     venue_to_delete = Venue.query.get(venue_id)
+    # Find the pages showing the venue while its shows still exist
+    stale_pages = venue_pages(venue_id)
     # Delete venue
     db.session.delete(venue_to_delete)
     db.session.commit()
@@ -214,12 +241,14 @@ def delete_venue(venue_id):
     abort(400)
     flash('Sorry, this venue could not be deleted.')
   else:
+    page_cache.invalidate(*stale_pages)
     flash('Venue was successfully deleted.')
     return render_template('pages/home.html')
 
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@page_cache.cached('artists')
 def artists():
   data = Artist.query.order_by('id').all()
   return render_template('pages/artists.html', artists=data)
@@ -227,70 +256,51 @@ def artists():
 @app.route('/artists/search', methods=['POST'])
 def search_artists():
   search_term = request.get_json()['search_term']
-  matches = Artist.query.filter(Artist.name.ilike('%' + search_term + '%')).all()
-  match_count = len(matches)
+  try:
+    limit = min(int(request.get_json().get('limit', app.config['SEARCH_RESULTS_LIMIT'])), app.config['SEARCH_RESULTS_MAX_LIMIT'])
+    matches, next_cursor = search(Artist, search_term, limit, request.get_json().get('cursor'))
+  except ValueError:
+    abort(400)
   match_details = []
   for match in matches:
-    current_time = datetime.now()
-    upcoming_shows = []
-    shows = match.shows
-    for show in shows:
-      show_datetime = datetime.strptime(show.start_time, '%Y-%m-%d %H:%M:%S')
-      if show_datetime > current_time:
-        upcoming_shows.append(show)
-    count_upcoming_shows = len(upcoming_shows)
     match_details.append({
       'id': match.id,
       'name': match.name,
-      'num_upcoming_shows': count_upcoming_shows
+      'num_upcoming_shows': match.num_upcoming_shows
     })
   response = {
-    'count': match_count,
-    'data': match_details
+    'count': len(match_details),
+    'data': match_details,
+    'next_cursor': next_cursor
   }
   return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 @app.route('/artists/<int:artist_id>')
+@page_cache.cached('artist:{artist_id}')
 def show_artist(artist_id):
   data = []
-  current_artist = Artist.query.get(artist_id)
-  # Convert genres to appropriately delimited values in a list
-  current_artist_genres_list = re.split(',', current_artist.genres)
-  # Initialize count of shows
-  num_upcoming_shows = 0
-  # Split shows into those in the future versus the past
-  upcoming_shows = []
-  past_shows = []
-  current_time = datetime.now()
-  shows = Show.query.filter_by(artist_id=artist_id).all()
-  for show in shows:
-    show_datetime = datetime.strptime(show.start_time, '%Y-%m-%d %H:%M:%S')
-    if show_datetime > current_time:
-      num_upcoming_shows += 1
-      upcoming_shows.append({
-        "id": show.id,
-        "artist_id": show.artist_id,
-        "artist": show.artist,
-        "venue_id": show.venue_id,
-        "venue_name": show.venue.name,
-        "venue_image_link": show.venue.image_link,
-        "start_time": show.start_time
-      })
-    elif show_datetime <= current_time:
-      past_shows.append({
-        "id": show.id,
-        "artist_id": show.artist_id,
-        "artist": show.artist,
-        "venue_id": show.venue_id,
-        "venue_name": show.venue.name,
-        "venue_image_link": show.venue.image_link,
-        "start_time": show.start_time
-      })
+  # Load the artist's genres in the same query as the artist itself
+  current_artist = Artist.query.options(joinedload(Artist.genres)).get(artist_id)
+  # Fetch every show with its venue's details in one joined projection,
+  # letting the database flag which shows are upcoming
+  shows = db.session.query(
+    Show.id,
+    Show.artist_id,
+    Show.venue_id,
+    Venue.name.label('venue_name'),
+    Venue.image_link.label('venue_image_link'),
+    Show.start_time,
+    (Show.start_time > datetime.now()).label('upcoming')
+  ).join(Venue, Show.venue_id == Venue.id).filter(
+    Show.artist_id == artist_id
+  ).order_by(Show.start_time).all()
+  upcoming_shows = [show._asdict() for show in shows if show.upcoming]
+  past_shows = [show._asdict() for show in reversed(shows) if not show.upcoming]
   data.append(
     {
       "id": current_artist.id,
       "name": current_artist.name,
-      "genres": current_artist_genres_list,
+      "genres": current_artist.genres,
       "city": current_artist.city,
       "state": current_artist.state,
       "phone": current_artist.phone,
@@ -298,8 +308,9 @@ def show_artist(artist_id):
       "facebook_link": current_artist.facebook_link,
       "seeking_venue": current_artist.seeking_venues,
       "image_link": current_artist.image_link,
-      "upcoming_shows_count": num_upcoming_shows,
+      "upcoming_shows_count": len(upcoming_shows),
       "upcoming_shows": upcoming_shows,
+      "past_shows_count": len(past_shows),
       "past_shows": past_shows
     }
   )
@@ -332,10 +343,12 @@ def edit_artist_submission(artist_id):
         'city': new_artist_city,
         'state': new_artist_state,
         'phone': new_artist_phone,
-        'genres': new_artist_genres,
         'facebook_link': new_artist_facebook_link
       }
     )
+    # Genres live in an association table, so replace them through the relationship
+    Artist.query.get(artist_id).genres = Genre.from_names(new_artist_genres)
+    stale_pages = artist_pages(artist_id)
     db.session.commit()
   except:
     error = True
@@ -347,6 +360,7 @@ def edit_artist_submission(artist_id):
     flash('Something went wrong. Please double-check your submission and try again.')
     abort(400)
   else:
+    page_cache.invalidate(*stale_pages)
     flash('Artist ' + new_artist_name + ' was successfully updated!')
     return render_template('pages/home.html')
 
@@ -373,10 +387,12 @@ def edit_venue_submission(venue_id):
         'city': new_venue_city,
         'state': new_venue_state,
         'phone': new_venue_phone,
-        'genres': new_venue_genres,
         'facebook_link': new_venue_facebook_link
       }
     )
+    # Genres live in an association table, so replace them through the relationship
+    Venue.query.get(venue_id).genres = Genre.from_names(new_venue_genres)
+    stale_pages = venue_pages(venue_id)
     db.session.commit()
   except:
     error = True
@@ -388,6 +404,7 @@ def edit_venue_submission(venue_id):
     flash('Something went wrong. Please double-check your submission and try again.')
     abort(400)
   else:
+    page_cache.invalidate(*stale_pages)
     flash('Artist ' + new_venue_name + ' was successfully updated!')
     return render_template('pages/home.html')
 
@@ -410,7 +427,7 @@ def create_artist_submission():
     new_artist_phone = request.get_json()['phone']
     new_artist_genres = request.get_json()['genres']
     new_artist_facebook_link = request.get_json()['facebook-link']
-    new_artist = Artist(name = new_artist_name, city = new_artist_city, state = new_artist_state, genres = new_artist_genres, facebook_link = new_artist_facebook_link)
+    new_artist = Artist(name = new_artist_name, city = new_artist_city, state = new_artist_state, genres = Genre.from_names(new_artist_genres), facebook_link = new_artist_facebook_link)
     # Add new artist record to db
     db.session.add(new_artist)
     db.session.commit()
@@ -424,6 +441,7 @@ def create_artist_submission():
     flash('Something went wrong. Please double-check your submission and try again.')
     abort(400)
   else:
+    page_cache.invalidate('artists')
     flash('Artist ' + new_artist_name + ' was successfully listed!')
     return render_template('pages/home.html')
 
@@ -433,6 +451,8 @@ def delete_artist(artist_id):
   body = {}
   try:
     artist_to_delete = Artist.query.get(artist_id)
+    # Find the pages showing the artist while its shows still exist
+    stale_pages = artist_pages(artist_id)
     # Delete artist
     db.session.delete(artist_to_delete)
     db.session.commit()
@@ -446,31 +466,74 @@ def delete_artist(artist_id):
     abort(400)
     flash('Sorry, this artist could not be deleted.')
   else:
+    page_cache.invalidate(*stale_pages)
     flash('Artist was successfully deleted.')
     return render_template('pages/home.html')
 
+#  Genres
+#  ----------------------------------------------------------------
+@app.route('/genres/<genre_name>')
+def show_genre(genre_name):
+  # Lists the venues and artists tagged with a genre, using the genre_id
+  # indexes on the association tables
+  genre = Genre.query.filter_by(name=genre_name).first_or_404()
+  venues = db.session.query(Venue.id, Venue.name).join(
+    VenueGenre, VenueGenre.c.venue_id == Venue.id
+  ).filter(VenueGenre.c.genre_id == genre.id).order_by(Venue.name).all()
+  artists = db.session.query(Artist.id, Artist.name).join(
+    ArtistGenre, ArtistGenre.c.artist_id == Artist.id
+  ).filter(ArtistGenre.c.genre_id == genre.id).order_by(Artist.name).all()
+  return render_template('pages/genre.html', genre=genre, venues=venues, artists=artists)
 
 #  Shows
 #----------------------------------------------------------------------------#
-# Displays list of shows at /shows
+# Shows are paginated by the (start_time, id) of the last show on a page
+def encode_show_cursor(show):
+  return '{}_{}'.format(show.start_time.isoformat(), show.id)
+
+def decode_show_cursor(cursor):
+  start_time, _, id = cursor.rpartition('_')
+  return datetime.fromisoformat(start_time), int(id)
+
+# Displays list of shows at /shows, a page at a time in start time order
 @app.route('/shows')
 def shows():
-  shows = Show.query.all()
-  data = []
-  for show in shows:
-    venue = db.session.query(Venue).filter_by(id=show.venue_id).first()
-    artist = db.session.query(Artist).filter_by(id=show.artist_id).first()
-    data.append(
-      {
-        "venue_id": show.venue_id,
-        "venue_name": venue.name,
-        "artist_id": show.artist_id,
-        "artist_name": artist.name,
-        "artist_image_link": artist.image_link,
-        "start_time": show.start_time
-      }
-    )
-  return render_template('pages/shows.html', shows=data)
+  # Fetch names and images alongside each show in one joined projection
+  query = db.session.query(
+    Show.id,
+    Show.venue_id,
+    Venue.name.label('venue_name'),
+    Show.artist_id,
+    Artist.name.label('artist_name'),
+    Artist.image_link.label('artist_image_link'),
+    Show.start_time
+  ).join(Venue, Show.venue_id == Venue.id).join(Artist, Show.artist_id == Artist.id)
+  try:
+    if request.args.get('venue_id'):
+      query = query.filter(Show.venue_id == int(request.args['venue_id']))
+    if request.args.get('artist_id'):
+      query = query.filter(Show.artist_id == int(request.args['artist_id']))
+    if request.args.get('from'):
+      query = query.filter(Show.start_time >= dateutil.parser.parse(request.args['from']))
+    if request.args.get('to'):
+      query = query.filter(Show.start_time < dateutil.parser.parse(request.args['to']))
+    # Resume after the (start_time, id) of the last show on the previous page
+    if request.args.get('after'):
+      last_start_time, last_id = decode_show_cursor(request.args['after'])
+      query = query.filter(or_(
+        Show.start_time > last_start_time,
+        and_(Show.start_time == last_start_time, Show.id > last_id)
+      ))
+  except (ValueError, OverflowError):
+    abort(400)
+  per_page = app.config['SHOWS_PER_PAGE']
+  # Fetch one row beyond the page to learn whether another page exists
+  data = query.order_by(Show.start_time, Show.id).limit(per_page + 1).all()
+  next_page = None
+  if len(data) > per_page:
+    data = data[:per_page]
+    next_page = url_for('shows', **dict(request.args.items(), after=encode_show_cursor(data[-1])))
+  return render_template('pages/shows.html', shows=data, next_page=next_page)
 
 @app.route('/shows/create')
 def create_shows():
@@ -486,7 +549,7 @@ def create_show_submission():
   try:
     show_artist_id = request.get_json()['artist_id']
     show_venue_id = request.get_json()['venue_id']
-    show_start_time = request.get_json()['start_time']
+    show_start_time = dateutil.parser.parse(request.get_json()['start_time'])
     new_show = Show(artist_id = show_artist_id, venue_id = show_venue_id, start_time = show_start_time)
     # Add new artist record to db
     db.session.add(new_show)
@@ -505,9 +568,33 @@ def create_show_submission():
     abort(400)
     flash('Something went wrong. Please double-check your submission and try again.')
   else:
+    page_cache.invalidate('venues', 'venue:{}'.format(show_venue_id), 'artist:{}'.format(show_artist_id))
     flash('Show was successfully listed!')
     return render_template('pages/home.html', error=error)
 
+#  Metrics
+#----------------------------------------------------------------------------#
+@app.route('/cache/metrics')
+def cache_metrics():
+  return jsonify(page_cache.stats())
+
+@app.route('/metrics')
+def metrics():
+  if not app.config['INSTRUMENTATION_ENABLED']:
+    abort(404)
+  return jsonify({
+    'query_budget': app.config['QUERY_BUDGET'],
+    'endpoints': instrumentation.snapshot(),
+    'page_cache': page_cache.stats()
+  })
+
+@app.route('/healthz')
+def healthz():
+  # Pool usage and checkout waits, and whether the database answers
+  health = pool_health(db.engine)
+  health['status'] = 'ok' if health['database'] == 'ok' else 'unavailable'
+  return jsonify(health), 200 if health['status'] == 'ok' else 503
+
 #----------------------------------------------------------------------------#
 # Error handlers
 #----------------------------------------------------------------------------#
@@ -0,0 +1,158 @@
+'''
+Benchmarks for Fyyur's read paths.
+
+Seeds a throwaway database at increasing scale and reports the latency and
+number of SQL round trips of each benchmarked page, or times template
+helpers over that many rows. Uses an in-memory SQLite database unless
+BENCHMARK_DATABASE_URL points elsewhere.
+
+    python benchmarks.py venues --sizes 100 1000 10000 100000
+    python benchmarks.py datetime --sizes 10000
+'''
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+# The benchmark drops every table, so it never uses the database DATABASE_URL names
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite://')
+
+import babel.dates
+import dateutil.parser
+from sqlalchemy import event
+
+from app import app, db, page_cache
+from formatting import format_datetime, format_datetimes
+from models import Venue, Artist, Show
+
+BATCH_SIZE = 10000
+
+
+def seed_venues(num_venues, shows_per_venue=2):
+    # Bulk insert rows directly rather than through the ORM unit of work
+    db.session.execute(Artist.__table__.insert(), [
+        {'name': 'Artist', 'city': 'San Francisco', 'state': 'CA'}
+    ])
+    now = datetime.now()
+    for start in range(0, num_venues, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, num_venues)
+        db.session.execute(Venue.__table__.insert(), [
+            {
+                'id': i + 1,
+                'name': 'Venue {}'.format(i),
+                'city': 'City {}'.format(i % 500),
+                'state': 'CA',
+                'address': '{} Main St'.format(i),
+                'phone': '555-555-5555',
+                'facebook_link': 'https://www.facebook.com/venue{}'.format(i)
+            }
+            for i in range(start, stop)
+        ])
+        db.session.execute(Show.__table__.insert(), [
+            {
+                'artist_id': 1,
+                'venue_id': i + 1,
+                'start_time': now + timedelta(days=j - shows_per_venue // 2)
+            }
+            for i in range(start, stop)
+            for j in range(shows_per_venue)
+        ])
+    db.session.commit()
+
+
+def measure(path, repeat=3):
+    '''
+    Returns the best wall-clock time and the number of SQL statements
+    issued for a GET request to path
+    '''
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    client = app.test_client()
+    best = None
+    event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        for _ in range(repeat):
+            del statements[:]
+            start = time.perf_counter()
+            res = client.get(path)
+            elapsed = time.perf_counter() - start
+            assert res.status_code == 200, res.status_code
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+    return best, len(statements)
+
+
+def bench_venues(size):
+    seed_venues(size)
+    return [('GET /venues',) + measure('/venues')]
+
+
+def bench_shows(size):
+    seed_venues(size)
+    return [('GET /shows',) + measure('/shows')]
+
+
+def legacy_format_datetime(value, format='medium'):
+    # The template filter as it was before formatting.py
+    date = dateutil.parser.parse(value)
+    if format == 'full':
+        format = "EEEE MMMM, d, y 'at' h:mma"
+    elif format == 'medium':
+        format = "EE MM, dd, y h:mma"
+    return babel.dates.format_datetime(date, format, locale='en_US')
+
+
+def bench_datetime(size):
+    start = datetime(2020, 1, 1, 20, 0)
+    values = [start + timedelta(hours=i) for i in range(size)]
+    strings = [str(value) for value in values]
+    cases = [
+        ('dateutil + babel (strings)', lambda: [legacy_format_datetime(value, 'full') for value in strings]),
+        ('compiled (strings)', lambda: [format_datetime(value, 'full') for value in strings]),
+        ('compiled (datetimes)', lambda: [format_datetime(value, 'full') for value in values]),
+        ('compiled batch (datetimes)', lambda: format_datetimes(values, 'full')),
+    ]
+    results = []
+    for label, run in cases:
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((label, best, 0))
+    return results
+
+
+BENCHMARKS = {
+    'venues': bench_venues,
+    'shows': bench_shows,
+    'datetime': bench_datetime,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Fyyur pages at increasing scale.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    args = parser.parse_args()
+
+    # Measure rendering from the database rather than from the page cache
+    page_cache.ttl = 0
+    print('{:>10} {:<28} {:>12} {:>12}'.format('size', 'case', 'seconds', 'statements'))
+    for size in args.sizes:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            for label, elapsed, statements in BENCHMARKS[args.benchmark](size):
+                print('{:>10} {:<28} {:>12.4f} {:>12}'.format(size, label, elapsed, statements))
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
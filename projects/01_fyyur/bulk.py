@@ -0,0 +1,297 @@
+'''
+Bulk import and export of venues, artists and shows.
+
+    flask data import venues venues.csv
+    flask data import shows shows.jsonl --batch-size 50000
+    flask data export shows shows.csv
+
+Files are CSV or JSON Lines, chosen by their extension. Rows are streamed in
+batches and written with multi-row inserts, or COPY on PostgreSQL. Genres
+are given as comma separated names, and shows refer to their venue and
+artist by name; both are resolved to ids through lookup tables built once
+per import.
+'''
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+from itertools import islice
+
+import click
+import dateutil.parser
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Venue, Artist, Show, Genre, VenueGenre, ArtistGenre
+
+FIELDS = {
+  'venues': ('name', 'city', 'state', 'address', 'phone', 'image_link', 'facebook_link', 'genres', 'website', 'seeking_talent', 'seeking_description'),
+  'artists': ('name', 'city', 'state', 'phone', 'image_link', 'facebook_link', 'genres', 'website', 'seeking_venues'),
+  'shows': ('venue_name', 'artist_name', 'start_time'),
+}
+
+BOOLEAN_FIELDS = ('seeking_talent', 'seeking_venues')
+
+# Model, genre association table and its foreign key for venues and artists
+ENTITIES = {
+  'venues': (Venue, VenueGenre, 'venue_id'),
+  'artists': (Artist, ArtistGenre, 'artist_id'),
+}
+
+
+def file_format(path):
+  if path.endswith('.csv'):
+    return 'csv'
+  if path.endswith('.jsonl') or path.endswith('.json'):
+    return 'jsonl'
+  raise click.BadParameter('Expected a .csv or .jsonl file', param_hint='path')
+
+
+def read_rows(file, format):
+  if format == 'csv':
+    for row in csv.DictReader(file):
+      yield row
+  else:
+    for line in file:
+      if line.strip():
+        yield json.loads(line)
+
+
+def batches(rows, batch_size):
+  rows = iter(rows)
+  while True:
+    batch = list(islice(rows, batch_size))
+    if not batch:
+      return
+    yield batch
+
+
+def parse_boolean(value):
+  if isinstance(value, str):
+    return value.strip().lower() in ('1', 'true', 'yes', 'y')
+  return bool(value)
+
+
+def parse_start_time(value):
+  if isinstance(value, datetime):
+    return value
+  try:
+    return datetime.fromisoformat(value)
+  except ValueError:
+    return dateutil.parser.parse(value)
+
+
+def genre_names(value):
+  if not value:
+    return []
+  if isinstance(value, str):
+    value = value.split(',')
+  return [name.strip() for name in value if name.strip()]
+
+
+def copy_rows(table, columns, rows):
+  # Streams rows into table with PostgreSQL's COPY through the session's connection
+  buffer = io.StringIO()
+  csv.writer(buffer).writerows(rows)
+  buffer.seek(0)
+  cursor = db.session.connection().connection.cursor()
+  cursor.copy_expert(
+    'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(table.name, ', '.join(columns)),
+    buffer
+  )
+
+
+def insert_rows(table, columns, rows):
+  if not rows:
+    return
+  if db.session.get_bind().dialect.name == 'postgresql':
+    copy_rows(table, columns, rows)
+  else:
+    db.session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+class GenreLookup(object):
+  '''
+  Maps genre names to ids, inserting genres that do not exist yet
+  '''
+  def __init__(self):
+    self.ids = dict(db.session.query(Genre.name, Genre.id))
+
+  def resolve(self, names):
+    missing = [name for name in dict.fromkeys(names) if name not in self.ids]
+    if missing:
+      db.session.execute(Genre.__table__.insert(), [{'name': name} for name in missing])
+      self.ids.update(db.session.query(Genre.name, Genre.id).filter(Genre.name.in_(missing)))
+    return [self.ids[name] for name in dict.fromkeys(names)]
+
+
+def import_entities(kind, rows, batch_size, progress):
+  model, link_table, link_key = ENTITIES[kind]
+  genres = GenreLookup()
+  fields = [field for field in FIELDS[kind] if field != 'genres']
+  # Bulk inserts bypass the ORM, so fill in column defaults up front
+  defaults = {}
+  for field in fields:
+    default = model.__table__.c[field].default
+    defaults[field] = default.arg if default is not None else None
+  imported = 0
+  for batch in batches(rows, batch_size):
+    records = []
+    for row in batch:
+      record = []
+      for field in fields:
+        value = row.get(field)
+        if value in (None, ''):
+          value = defaults[field]
+        elif field in BOOLEAN_FIELDS:
+          value = parse_boolean(value)
+        record.append(value)
+      records.append(record)
+    insert_rows(model.__table__, fields, records)
+    names = [row['name'] for row in batch]
+    ids = dict(db.session.query(model.name, model.id).filter(model.name.in_(names)))
+    links = []
+    for row in batch:
+      for genre_id in genres.resolve(genre_names(row.get('genres'))):
+        links.append((ids[row['name']], genre_id))
+    insert_rows(link_table, (link_key, 'genre_id'), links)
+    db.session.commit()
+    imported += len(batch)
+    progress(imported)
+  return imported
+
+
+def import_shows(rows, batch_size, progress):
+  # Resolve venue and artist names to ids once for the whole import
+  venue_ids = dict(db.session.query(Venue.name, Venue.id))
+  artist_ids = dict(db.session.query(Artist.name, Artist.id))
+  imported = 0
+  for batch in batches(rows, batch_size):
+    records = []
+    for row in batch:
+      try:
+        records.append((
+          artist_ids[row['artist_name']],
+          venue_ids[row['venue_name']],
+          parse_start_time(row['start_time'])
+        ))
+      except KeyError as e:
+        raise click.ClickException('Unknown venue or artist {} in row {}'.format(e, imported + len(records) + 1))
+    insert_rows(Show.__table__, ('artist_id', 'venue_id', 'start_time'), records)
+    db.session.commit()
+    imported += len(batch)
+    progress(imported)
+  return imported
+
+
+def export_entities(kind, batch_size):
+  model, link_table, link_key = ENTITIES[kind]
+  fields = FIELDS[kind]
+  columns = [getattr(model, field) for field in fields if field != 'genres']
+  last_id = 0
+  while True:
+    # Walk the table in primary key order a batch at a time
+    batch = db.session.query(model.id, *columns).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+    if not batch:
+      return
+    last_id = batch[-1].id
+    genres = {}
+    for owner_id, name in db.session.query(link_table.c[link_key], Genre.name).join(
+      Genre, Genre.id == link_table.c.genre_id
+    ).filter(link_table.c[link_key].in_([row.id for row in batch])).order_by(Genre.name):
+      genres.setdefault(owner_id, []).append(name)
+    for row in batch:
+      record = row._asdict()
+      record['genres'] = ','.join(genres.get(record.pop('id'), []))
+      yield record
+
+
+def export_shows(batch_size):
+  last_id = 0
+  while True:
+    batch = db.session.query(
+      Show.id,
+      Venue.name.label('venue_name'),
+      Artist.name.label('artist_name'),
+      Show.start_time
+    ).join(Venue, Show.venue_id == Venue.id).join(Artist, Show.artist_id == Artist.id).filter(
+      Show.id > last_id
+    ).order_by(Show.id).limit(batch_size).all()
+    if not batch:
+      return
+    last_id = batch[-1].id
+    for row in batch:
+      yield {
+        'venue_name': row.venue_name,
+        'artist_name': row.artist_name,
+        'start_time': row.start_time.isoformat()
+      }
+
+
+def write_rows(file, format, fields, rows):
+  written = 0
+  if format == 'csv':
+    writer = csv.DictWriter(file, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+      writer.writerow(row)
+      written += 1
+  else:
+    for row in rows:
+      file.write(json.dumps(row) + '\n')
+      written += 1
+  return written
+
+
+@click.group('data')
+def data_cli():
+  '''Bulk import and export of venues, artists and shows.'''
+
+
+@data_cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(FIELDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per insert and commit.')
+@with_appcontext
+def import_command(kind, path, batch_size):
+  '''Import rows of KIND from a CSV or JSON Lines file at PATH.'''
+  format = file_format(path)
+
+  def progress(count):
+    click.echo('{}: {} rows imported'.format(kind, count), err=True)
+
+  with open(path, newline='') as file:
+    rows = read_rows(file, format)
+    if kind in ENTITIES:
+      total = import_entities(kind, rows, batch_size, progress)
+    else:
+      total = import_shows(rows, batch_size, progress)
+  # Imported rows show on cached pages such as the venue and artist lists.
+  # Clearing reaches other processes through a shared CACHE_REDIS_URL store;
+  # in-process caches of running servers expire after CACHE_TTL
+  page_cache = current_app.extensions.get('page_cache')
+  if page_cache is not None:
+    page_cache.clear()
+  click.echo('Imported {} {}'.format(total, kind))
+
+
+@data_cli.command('export')
+@click.argument('kind', type=click.Choice(sorted(FIELDS)))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']), help='Defaults to the extension of PATH.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows fetched per query.')
+@with_appcontext
+def export_command(kind, path, format, batch_size):
+  '''Export every row of KIND to a CSV or JSON Lines file at PATH.'''
+  format = format or file_format(path)
+  if kind in ENTITIES:
+    rows = export_entities(kind, batch_size)
+  else:
+    rows = export_shows(batch_size)
+  if path == '-':
+    total = write_rows(sys.stdout, format, FIELDS[kind], rows)
+  else:
+    with open(path, 'w', newline='') as file:
+      total = write_rows(file, format, FIELDS[kind], rows)
+  click.echo('Exported {} {}'.format(total, kind), err=True)
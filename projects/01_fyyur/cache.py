@@ -0,0 +1,159 @@
+'''
+Rendered page cache.
+
+Pages are cached under short keys such as 'venues' or 'venue:1' in one of
+two backends: an in-process LRU with a per-entry TTL, or a shared store
+reached through a Redis-style client (anything with get, setex, delete and
+scan_iter) so that every worker sees the same entries and invalidations.
+Mutation handlers delete exactly the keys of the pages they change; the TTL
+bounds how stale a page can get otherwise, for example when an upcoming show
+moves into the past.
+'''
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import session
+
+
+class LRUCache(object):
+  '''
+  In-process cache evicting the least recently used entry beyond max_entries
+  '''
+  def __init__(self, max_entries=1024):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      value, expires_at = entry
+      if expires_at <= time.monotonic():
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return value
+
+  def set(self, key, value, ttl):
+    with self.lock:
+      self.entries[key] = (value, time.monotonic() + ttl)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def delete(self, *keys):
+    with self.lock:
+      for key in keys:
+        self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
+
+class SharedCache(object):
+  '''
+  Cache kept in a shared store through a Redis-style client, with keys
+  namespaced by prefix
+  '''
+  def __init__(self, client, prefix='fyyur:page:'):
+    self.client = client
+    self.prefix = prefix
+
+  def get(self, key):
+    value = self.client.get(self.prefix + key)
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+  def set(self, key, value, ttl):
+    self.client.setex(self.prefix + key, int(ttl), value)
+
+  def delete(self, *keys):
+    if keys:
+      self.client.delete(*[self.prefix + key for key in keys])
+
+  def clear(self):
+    keys = list(self.client.scan_iter(match=self.prefix + '*'))
+    if keys:
+      self.client.delete(*keys)
+
+  def __len__(self):
+    return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*'))
+
+
+class PageCache(object):
+  '''
+  Caches the output of views and counts hits and misses
+  '''
+  def __init__(self, backend, ttl=300):
+    self.backend = backend
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    # Guards the counters, which the threads serving requests share
+    self.lock = threading.Lock()
+
+  @classmethod
+  def from_config(cls, config):
+    # Uses a shared Redis store when CACHE_REDIS_URL is set, otherwise an
+    # in-process LRU. The redis package is only needed for the former.
+    if config.get('CACHE_REDIS_URL'):
+      import redis
+      backend = SharedCache(redis.from_url(config['CACHE_REDIS_URL']))
+    else:
+      backend = LRUCache(config.get('CACHE_MAX_ENTRIES', 1024))
+    return cls(backend, config.get('CACHE_TTL', 300))
+
+  def cached(self, key):
+    '''
+    Decorates a view so that its rendered output is cached under key,
+    formatted with the view's arguments
+    '''
+    def decorator(f):
+      @wraps(f)
+      def wrapper(**kwargs):
+        # Pages carrying flashed messages are specific to one visitor
+        if self.ttl <= 0 or '_flashes' in session:
+          return f(**kwargs)
+        cache_key = key.format(**kwargs)
+        page = self.backend.get(cache_key)
+        if page is not None:
+          with self.lock:
+            self.hits += 1
+          return page
+        with self.lock:
+          self.misses += 1
+        page = f(**kwargs)
+        self.backend.set(cache_key, page, self.ttl)
+        return page
+      return wrapper
+    return decorator
+
+  def invalidate(self, *keys):
+    self.backend.delete(*keys)
+
+  def clear(self):
+    # Keeps the hit and miss counts, which reset_stats() starts over
+    self.backend.clear()
+
+  def reset_stats(self):
+    with self.lock:
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    with self.lock:
+      hits, misses = self.hits, self.misses
+    lookups = hits + misses
+    return {
+      'hits': hits,
+      'misses': misses,
+      'hit_rate': hits / lookups if lookups else 0.0,
+      'entries': len(self.backend)
+    }
@@ -10,4 +10,37 @@ DEBUG = True
 
 # IMPLEMENT DATABASE URL
 SQLALCHEMY_DATABASE_URI = 'postgres://postgres@localhost:5432/fyyur'
-SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Database connection pool: connections kept open, extra connections opened
+# under load, seconds to wait for a connection and before replacing one, and
+# whether to test connections before use. Statements running longer than
+# DB_STATEMENT_TIMEOUT milliseconds are cancelled on PostgreSQL.
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+DB_POOL_PRE_PING = True
+DB_STATEMENT_TIMEOUT = None
+
+# Default and maximum number of results per page of venue or artist search
+SEARCH_RESULTS_LIMIT = 20
+SEARCH_RESULTS_MAX_LIMIT = 100
+
+# Number of shows listed per page at /shows
+SHOWS_PER_PAGE = 30
+
+# Rendered pages are cached for CACHE_TTL seconds (0 disables caching), in
+# process or, when CACHE_REDIS_URL is set, in a Redis store shared by workers
+CACHE_TTL = 300
+CACHE_MAX_ENTRIES = 1024
+CACHE_REDIS_URL = None
+
+# Locale used to format dates and times in templates
+DATETIME_LOCALE = 'en_US'
+
+# Record request latency, SQL statement counts and template render time,
+# served at /metrics, and log requests issuing more than QUERY_BUDGET
+# SQL statements
+INSTRUMENTATION_ENABLED = False
+QUERY_BUDGET = 10
\ No newline at end of file
@@ -0,0 +1,62 @@
+'''
+Datetime formatting for templates.
+
+Babel's format_datetime resolves the locale and looks up the pattern on
+every call, and the filter this replaces also ran dateutil's generic parser
+over every value. Here each (locale, format) pair is compiled into a Babel
+pattern once and reused, typed datetimes are formatted directly, and strings
+only fall back to dateutil when they are not ISO 8601.
+'''
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import babel.dates
+import dateutil.parser
+from babel import Locale
+
+# Named formats used by the templates, as Babel patterns
+DATETIME_FORMATS = {
+  'full': "EEEE MMMM, d, y 'at' h:mma",
+  'medium': "EE MM, dd, y h:mma",
+}
+
+DEFAULT_LOCALE = 'en_US'
+
+
+@lru_cache(maxsize=64)
+def compile_format(locale, format):
+  # Returns the parsed Locale and DateTimePattern for a locale and format
+  pattern = DATETIME_FORMATS.get(format, format)
+  return Locale.parse(locale), babel.dates.parse_pattern(pattern)
+
+
+def to_datetime(value):
+  if isinstance(value, datetime):
+    return value
+  try:
+    return datetime.fromisoformat(value)
+  except ValueError:
+    return dateutil.parser.parse(value)
+
+
+def format_datetimes(values, format='medium', locale=DEFAULT_LOCALE):
+  '''
+  Formats a sequence of datetimes or datetime strings, compiling the
+  format once for the whole batch
+  '''
+  if format in ('long', 'short'):
+    # Babel's own named formats combine separate date and time patterns
+    return [babel.dates.format_datetime(to_datetime(value), format, locale=locale) for value in values]
+  locale, pattern = compile_format(locale, format)
+  formatted = []
+  for value in values:
+    date = to_datetime(value)
+    if date.tzinfo is None:
+      # Match babel.dates.format_datetime, which treats naive values as UTC
+      date = date.replace(tzinfo=timezone.utc)
+    formatted.append(pattern.apply(date, locale))
+  return formatted
+
+
+def format_datetime(value, format='medium', locale=DEFAULT_LOCALE):
+  return format_datetimes((value,), format, locale)[0]
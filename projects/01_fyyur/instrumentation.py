@@ -0,0 +1,139 @@
+'''
+Opt-in request instrumentation.
+
+When INSTRUMENTATION_ENABLED is set, every request records its latency, the
+number and total time of the SQL statements it issued (through SQLAlchemy
+cursor events) and the time spent rendering templates (through Flask's
+template signals, which need blinker). Totals are kept per endpoint along
+with a latency histogram. Requests issuing more than QUERY_BUDGET statements
+are logged as warnings and counted, so that N+1 query patterns show up as
+soon as they are introduced.
+'''
+import threading
+import time
+from bisect import bisect_left
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+
+class EndpointStats(object):
+  def __init__(self):
+    self.requests = 0
+    self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+    self.latency_seconds = 0.0
+    self.sql_statements = 0
+    self.sql_seconds = 0.0
+    self.template_seconds = 0.0
+    self.over_query_budget = 0
+
+  def to_dict(self):
+    return {
+      'requests': self.requests,
+      'latency_seconds': self.latency_seconds,
+      'latency_histogram': [
+        {'le': bound if bound != float('inf') else '+Inf', 'count': count}
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)
+      ],
+      'sql_statements': self.sql_statements,
+      'sql_seconds': self.sql_seconds,
+      'template_seconds': self.template_seconds,
+      'over_query_budget': self.over_query_budget
+    }
+
+
+class RequestTimings(object):
+  '''
+  Measurements of the request in progress, kept on flask.g
+  '''
+  def __init__(self):
+    self.started_at = time.perf_counter()
+    self.sql_statements = 0
+    self.sql_seconds = 0.0
+    self.template_seconds = 0.0
+    self.template_started_at = None
+
+
+class Instrumentation(object):
+  def __init__(self, app=None):
+    self.endpoints = {}
+    self.lock = threading.Lock()
+    self.app = None
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    self.app = app
+    app.before_request(self.start_request)
+    app.after_request(self.finish_request)
+    event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+    before_render_template.connect(self.before_render_template, app)
+    template_rendered.connect(self.template_rendered, app)
+
+  def current(self):
+    if has_request_context():
+      return g.get('request_timings')
+    return None
+
+  def start_request(self):
+    if self.app.config.get('INSTRUMENTATION_ENABLED'):
+      g.request_timings = RequestTimings()
+
+  def finish_request(self, response):
+    timings = self.current()
+    if timings is None:
+      return response
+    latency = time.perf_counter() - timings.started_at
+    endpoint = request.endpoint or 'unmatched'
+    budget = self.app.config.get('QUERY_BUDGET')
+    over_budget = budget is not None and timings.sql_statements > budget
+    with self.lock:
+      stats = self.endpoints.setdefault(endpoint, EndpointStats())
+      stats.requests += 1
+      stats.latency_buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+      stats.latency_seconds += latency
+      stats.sql_statements += timings.sql_statements
+      stats.sql_seconds += timings.sql_seconds
+      stats.template_seconds += timings.template_seconds
+      stats.over_query_budget += over_budget
+    if over_budget:
+      self.app.logger.warning(
+        '%s %s issued %d SQL statements, over the budget of %d',
+        request.method, request.path, timings.sql_statements, budget
+      )
+    response.headers['X-Query-Count'] = str(timings.sql_statements)
+    return response
+
+  def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    if self.current() is not None:
+      conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+  def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+    timings = self.current()
+    if timings is not None and conn.info.get('query_started_at'):
+      timings.sql_statements += 1
+      timings.sql_seconds += time.perf_counter() - conn.info['query_started_at'].pop()
+
+  def before_render_template(self, sender, template, context, **extra):
+    timings = self.current()
+    if timings is not None:
+      timings.template_started_at = time.perf_counter()
+
+  def template_rendered(self, sender, template, context, **extra):
+    timings = self.current()
+    if timings is not None and timings.template_started_at is not None:
+      timings.template_seconds += time.perf_counter() - timings.template_started_at
+      timings.template_started_at = None
+
+  def snapshot(self):
+    with self.lock:
+      return {endpoint: stats.to_dict() for endpoint, stats in self.endpoints.items()}
+
+  def reset(self):
+    with self.lock:
+      self.endpoints.clear()
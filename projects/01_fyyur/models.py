@@ -3,6 +3,42 @@ from flask_sqlalchemy import SQLAlchemy
 # Instantiate SQLAlchemy db object
 db = SQLAlchemy()
 
+# Association tables linking venues and artists to their genres. The primary
+# keys serve lookups by venue or artist, the genre_id indexes browsing by genre
+VenueGenre = db.Table('VenueGenre',
+    db.Column('venue_id', db.Integer, db.ForeignKey('Venue.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True, index=True)
+)
+
+ArtistGenre = db.Table('ArtistGenre',
+    db.Column('artist_id', db.Integer, db.ForeignKey('Artist.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('Genre.id'), primary_key=True, index=True)
+)
+
+class Genre(db.Model):
+    __tablename__ = 'Genre'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False, unique=True)
+
+    @classmethod
+    def from_names(cls, names):
+        # Accepts a list or comma separated string of genre names and returns
+        # their Genre rows, adding any that do not exist yet to the session
+        if isinstance(names, str):
+            names = names.split(',')
+        names = list(dict.fromkeys(name.strip() for name in names if name.strip()))
+        if not names:
+            return []
+        existing = {genre.name: genre for genre in cls.query.filter(cls.name.in_(names))}
+        genres = []
+        for name in names:
+            genre = existing.get(name)
+            if genre is None:
+                genre = cls(name=name)
+                db.session.add(genre)
+            genres.append(genre)
+        return genres
+
 class Venue(db.Model):
     __tablename__ = 'Venue'
     id = db.Column(db.Integer, primary_key=True)
@@ -13,7 +49,7 @@ class Venue(db.Model):
     phone = db.Column(db.String(120), nullable=False)
     image_link = db.Column(db.String(500), default="https://cdn10.phillymag.com/wp-content/uploads/sites/3/2018/11/live-music-concert-venue-philadelphia-1024x683.jpg")
     facebook_link = db.Column(db.String(120), nullable=False, unique=True)
-    genres = db.Column(db.String(120), nullable=False)
+    genres = db.relationship('Genre', secondary=VenueGenre, order_by='Genre.name')
     website = db.Column(db.String(500))
     seeking_talent = db.Column(db.Boolean, default=True)
     seeking_description = db.Column(db.String(250))
@@ -26,7 +62,7 @@ class Artist(db.Model):
     city = db.Column(db.String(120), nullable=False)
     state = db.Column(db.String(120), nullable=False)
     phone = db.Column(db.String(120))
-    genres = db.Column(db.String(120))
+    genres = db.relationship('Genre', secondary=ArtistGenre, order_by='Genre.name')
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120), unique=True)
     website = db.Column(db.String(500))
@@ -35,9 +71,31 @@ class Artist(db.Model):
 
 class Show(db.Model):
   __tablename__ = 'Show'
+  # Composite indexes let the past/upcoming split of a venue's or artist's
+  # shows be answered with a range scan
+  __table_args__ = (
+    db.Index('ix_Show_venue_id_start_time', 'venue_id', 'start_time'),
+    db.Index('ix_Show_artist_id_start_time', 'artist_id', 'start_time'),
+    # Serves the keyset-paginated /shows listing
+    db.Index('ix_Show_start_time_id', 'start_time', 'id'),
+  )
   id = db.Column(db.Integer, primary_key=True)
   artist_id = db.Column(db.Integer, db.ForeignKey('Artist.id'), nullable=False)
   artist = db.relationship('Artist', backref='Show', lazy=True)
   venue_id = db.Column(db.Integer, db.ForeignKey('Venue.id'), nullable=False)
   venue = db.relationship('Venue', backref='Show', lazy=True)
-  start_time = db.Column(db.String(500), nullable=False)
\ No newline at end of file
+  start_time = db.Column(db.DateTime, nullable=False)
+
+  @classmethod
+  def count_upcoming(cls, owner, current_time):
+    # Correlated subquery counting the upcoming shows of each Venue or Artist row
+    owner_id = cls.venue_id if owner is Venue else cls.artist_id
+    query = db.session.query(db.func.count(cls.id)).filter(
+      owner_id == owner.id,
+      cls.start_time > current_time
+    ).correlate(owner)
+    # scalar_subquery() replaced as_scalar() in SQLAlchemy 1.4, and 2.0 drops
+    # as_scalar(); requirements.txt pins 1.3, which only has as_scalar()
+    if hasattr(query, 'scalar_subquery'):
+      return query.scalar_subquery()
+    return query.as_scalar()
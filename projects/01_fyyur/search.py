@@ -0,0 +1,120 @@
+'''
+Ranked search over venues and artists.
+
+Matches a term against each row's name and city, or the name of one of its
+genres. On PostgreSQL the name and city match is served by a pg_trgm GIN
+index over that same expression and ranked by trigram similarity; other
+databases fall back to a plain ILIKE scan with prefix matches ranked first.
+Genre matches are looked up through the association tables' genre_id
+index, and joined to the name and city matches with a UNION rather than an
+OR, which would keep PostgreSQL from using the trigram index. Results are
+paginated with an opaque cursor holding the (rank, id) of the last row
+returned.
+'''
+import base64
+import json
+import re
+from datetime import datetime
+from decimal import Decimal
+import sqlalchemy
+from sqlalchemy import DDL, Numeric, and_, case, cast, event, func, or_
+
+from models import db, Show, Genre
+
+
+def search_document(model):
+  # The expression both the trigram index and the search query are built on
+  return func.lower(model.name + ' ' + model.city)
+
+
+# Trigram indexes only exist on PostgreSQL, so create them outside the models
+event.listen(
+  db.Model.metadata,
+  'before_create',
+  DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+for table in ('Venue', 'Artist'):
+  event.listen(
+    db.Model.metadata,
+    'after_create',
+    DDL(
+      'CREATE INDEX IF NOT EXISTS "ix_{0}_search_trgm" ON "{0}" USING gin '
+      '(lower(name || \' \' || city) gin_trgm_ops)'.format(table)
+    ).execute_if(dialect='postgresql')
+  )
+
+
+# case() takes its whens as positional arguments from SQLAlchemy 1.4, the only
+# form 2.0 accepts, and as a list in the 1.3 releases requirements.txt pins
+CASE_WHENS_POSITIONAL = tuple(int(part) for part in sqlalchemy.__version__.split('.')[:2]) >= (1, 4)
+
+
+def case_when(condition, value, else_):
+  if CASE_WHENS_POSITIONAL:
+    return case((condition, value), else_=else_)
+  return case([(condition, value)], else_=else_)
+
+
+# Escapes LIKE wildcards so that the term is matched literally
+def escape_like(term):
+  return re.sub(r'([\\%_])', r'\\\1', term)
+
+
+def encode_cursor(rank, id):
+  # Ranks are exact decimals so that the next page resumes precisely
+  return base64.urlsafe_b64encode(json.dumps([str(rank), id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+  try:
+    rank, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return Decimal(rank), int(id)
+  except (ValueError, TypeError, ArithmeticError):
+    raise ValueError('Invalid search cursor')
+
+
+def matching_ids(model, document, term):
+  # Ids of model rows whose name or city contains term, or with a genre named
+  # term, as a UNION rather than an OR so that each side can use its own
+  # index: the trigram index on PostgreSQL, and the association table's
+  # genre_id index
+  association = model.genres.property.secondary
+  owner_id = next(column for column in association.c if column.references(model.__table__.c.id))
+  genre_ids = db.session.query(Genre.id).filter(func.lower(Genre.name) == term)
+  by_document = db.session.query(model.id).filter(document.like('%' + escape_like(term) + '%', escape='\\'))
+  by_genre = db.session.query(owner_id).filter(association.c.genre_id.in_(genre_ids.subquery()))
+  return by_document.union(by_genre).correlate(None).subquery()
+
+
+def search(model, search_term, limit, cursor=None):
+  '''
+  Returns a page of (id, name, num_upcoming_shows, rank) rows of model
+  matching search_term, best match first, and the cursor of the next page,
+  or None on the last page
+  '''
+  term = search_term.strip().lower()
+  document = search_document(model)
+  if db.session.get_bind().dialect.name == 'postgresql':
+    rank = func.round(cast(func.similarity(document, term), Numeric), 6)
+  else:
+    rank = cast(case_when(func.lower(model.name).like(escape_like(term) + '%', escape='\\'), 1, else_=0), Numeric)
+  rank = rank.label('rank')
+  query = db.session.query(
+    model.id,
+    model.name,
+    Show.count_upcoming(model, datetime.now()).label('num_upcoming_shows'),
+    rank
+  ).filter(model.id.in_(matching_ids(model, document, term)))
+  if cursor:
+    last_rank, last_id = decode_cursor(cursor)
+    query = query.filter(or_(
+      rank.element < last_rank,
+      and_(rank.element == last_rank, model.id > last_id)
+    ))
+  # Fetch one row beyond the page to learn whether another page exists
+  rows = query.order_by(rank.element.desc(), model.id).limit(limit + 1).all()
+  next_cursor = None
+  if len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1].rank, rows[-1].id)
+  return rows, next_cursor
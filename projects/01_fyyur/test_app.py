@@ -0,0 +1,456 @@
+import fnmatch
+import importlib.util
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+# Never the database DATABASE_URL names, since the tests drop every table
+os.environ['DATABASE_URL'] = os.environ.get('FYYUR_TEST_DATABASE_URL', 'sqlite://')
+
+import babel.dates
+from flask import Flask
+from sqlalchemy import event
+
+from app import app, db, page_cache, instrumentation
+from cache import LRUCache, PageCache, SharedCache
+from models import Venue, Artist, Show, Genre
+from search import search
+from formatting import format_datetime, format_datetimes
+from pool import MonitoredQueuePool, engine_options
+
+
+class FakeRedis(object):
+    """Stands in for a Redis client in shared cache tests"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value.encode('utf-8') if value is not None else None
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.values) if fnmatch.fnmatch(key, match)]
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the Fyyur test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SHOWS_PER_PAGE'] = 30
+        app.config['INSTRUMENTATION_ENABLED'] = False
+        app.config['QUERY_BUDGET'] = 10
+        self.client = app.test_client
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        page_cache.clear()
+        page_cache.reset_stats()
+        # Record every statement sent to the database
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        """Executed after reach test"""
+        event.remove(db.engine, 'before_cursor_execute', self.record_statement)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def count_statements(self, path):
+        page_cache.clear()
+        self.statements = []
+        res = self.client().get(path)
+        self.assertEqual(res.status_code, 200)
+        # The test's app context outlives the request, so end its session
+        # here as the request teardown would
+        db.session.remove()
+        return len(self.statements)
+
+    def seed(self, num_venues, shows_per_venue=2):
+        artist = Artist.query.first()
+        if artist is None:
+            artist = Artist(name='Artist', city='San Francisco', state='CA', genres=Genre.from_names('Jazz'))
+            db.session.add(artist)
+        genres = Genre.from_names('Jazz, Folk')
+        now = datetime.now()
+        offset = Venue.query.count()
+        for i in range(offset, offset + num_venues):
+            venue = Venue(
+                name='Venue {}'.format(i),
+                city='City {}'.format(i % 5),
+                state='CA',
+                address='{} Main St'.format(i),
+                phone='555-555-5555',
+                facebook_link='https://www.facebook.com/venue{}'.format(i),
+                genres=genres
+            )
+            db.session.add(venue)
+            for j in range(shows_per_venue):
+                start_time = now + timedelta(days=1) if j % 2 == 0 else now - timedelta(days=1)
+                db.session.add(Show(artist=artist, venue=venue, start_time=start_time))
+        db.session.commit()
+
+    def test_venues_groups_by_area(self):
+        self.seed(10)
+        res = self.client().get('/venues')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertEqual(body.count('<h3>'), 5)
+        self.assertIn('City 0, CA', body)
+        self.assertIn('Venue 9', body)
+
+    def test_venues_query_count_is_constant(self):
+        self.seed(10)
+        small = self.count_statements('/venues')
+        self.seed(90)
+        self.assertEqual(self.count_statements('/venues'), small)
+
+    def test_search_venues_counts_upcoming_shows(self):
+        self.seed(3, shows_per_venue=3)
+        res = self.client().post('/venues/search', json={'search_term': 'venue 1'})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Number of search results for "": 1', res.get_data(as_text=True))
+
+    def test_search_venues_ranks_prefix_matches_first(self):
+        self.seed(12)
+        res = self.client().post('/venues/search', json={'search_term': 'venue 1', 'limit': 2})
+        body = res.get_data(as_text=True)
+        self.assertIn('Venue 1<', body)
+        self.assertIn('Venue 10<', body)
+        self.assertNotIn('Venue 11<', body)
+
+    def test_search_cursor_paginates_without_overlap(self):
+        self.seed(12)
+        names = []
+        cursor = None
+        while True:
+            with app.test_request_context():
+                rows, cursor = search(Venue, 'city 1', 1, cursor)
+            names.extend(row.name for row in rows)
+            if cursor is None:
+                break
+        self.assertEqual(sorted(names), ['Venue 1', 'Venue 11', 'Venue 6'])
+
+    def test_search_matches_wildcards_literally(self):
+        self.seed(3)
+        for term in ('_', '%', 'venue_1'):
+            with app.test_request_context():
+                rows, cursor = search(Venue, term, 10)
+            self.assertEqual(rows, [], term)
+
+    def test_search_rejects_invalid_cursor(self):
+        res = self.client().post('/artists/search', json={'search_term': 'a', 'cursor': 'nonsense'})
+        self.assertEqual(res.status_code, 400)
+
+    def test_shows_paginates_in_start_time_order(self):
+        app.config['SHOWS_PER_PAGE'] = 4
+        self.seed(5, shows_per_venue=2)
+        seen = []
+        path = '/shows'
+        while path:
+            res = self.client().get(path)
+            self.assertEqual(res.status_code, 200)
+            body = res.get_data(as_text=True)
+            seen.extend(re.findall(r'/venues/(\d+)"', body))
+            match = re.search(r'href="(/shows\?[^"]+)"', body)
+            path = match.group(1).replace('&amp;', '&') if match else None
+        self.assertEqual(len(seen), 10)
+
+    def test_shows_filters_by_venue(self):
+        self.seed(5, shows_per_venue=2)
+        res = self.client().get('/shows?venue_id=2')
+        self.assertEqual(re.findall(r'/venues/(\d+)"', res.get_data(as_text=True)), ['2', '2'])
+
+    def test_shows_query_count_is_constant(self):
+        self.seed(2)
+        small = self.count_statements('/shows')
+        self.seed(20)
+        self.assertEqual(self.count_statements('/shows'), small)
+
+    def test_shows_rejects_invalid_cursor(self):
+        res = self.client().get('/shows?after=nonsense')
+        self.assertEqual(res.status_code, 400)
+
+    def test_show_genre_lists_venues_and_artists(self):
+        self.seed(2)
+        res = self.client().get('/genres/Folk')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('Venue 1', body)
+        self.assertNotIn('Artist<', body)
+        self.assertEqual(self.client().get('/genres/Polka').status_code, 404)
+
+    def test_search_matches_genre(self):
+        self.seed(2)
+        res = self.client().post('/artists/search', json={'search_term': 'jazz'})
+        self.assertIn('"": 1', res.get_data(as_text=True))
+
+    def test_edit_venue_replaces_genres(self):
+        self.seed(1)
+        res = self.client().post('/venues/1/edit', json={
+            'name': 'Venue 0',
+            'city': 'City 0',
+            'state': 'CA',
+            'phone': '555-555-5555',
+            'genres': 'Rock n Roll, Jazz',
+            'facebook-link': 'https://www.facebook.com/venue0'
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([genre.name for genre in Venue.query.get(1).genres], ['Jazz', 'Rock n Roll'])
+        self.assertEqual(Genre.query.count(), 3)
+
+    def test_bulk_import_and_export_round_trip(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        venues_path = os.path.join(directory, 'venues.csv')
+        with open(venues_path, 'w') as file:
+            file.write('name,city,state,address,phone,facebook_link,genres,seeking_talent\n')
+            file.write('The Dueling Pianos Bar,New York,NY,335 Delancey Street,914-003-1132,https://www.facebook.com/theduelingpianos,"Classical, R&B",false\n')
+            file.write('Park Square Live,San Francisco,CA,34 Whiskey Moore Ave,415-000-1234,https://www.facebook.com/ParkSquareLive,Jazz,\n')
+        artists_path = os.path.join(directory, 'artists.jsonl')
+        with open(artists_path, 'w') as file:
+            file.write(json.dumps({'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'genres': ['Rock n Roll', 'Jazz']}) + '\n')
+        shows_path = os.path.join(directory, 'shows.csv')
+        with open(shows_path, 'w') as file:
+            file.write('venue_name,artist_name,start_time\n')
+            file.write('Park Square Live,Guns N Petals,2035-04-01T20:00:00\n')
+            file.write('The Dueling Pianos Bar,Guns N Petals,2019-05-21 21:30:00\n')
+
+        runner = app.test_cli_runner()
+        for kind, path in (('venues', venues_path), ('artists', artists_path), ('shows', shows_path)):
+            result = runner.invoke(args=['data', 'import', kind, path, '--batch-size', '1'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+        venue = Venue.query.filter_by(name='The Dueling Pianos Bar').one()
+        self.assertEqual([genre.name for genre in venue.genres], ['Classical', 'R&B'])
+        self.assertFalse(venue.seeking_talent)
+        self.assertTrue(Venue.query.filter_by(name='Park Square Live').one().seeking_talent)
+        self.assertEqual(Genre.query.count(), 4)
+        self.assertEqual(Show.query.count(), 2)
+
+        result = runner.invoke(args=['data', 'export', 'shows', '-', '--format', 'jsonl'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        exported = [json.loads(line) for line in result.output.splitlines() if line.startswith('{')]
+        self.assertEqual(exported[0], {
+            'venue_name': 'Park Square Live',
+            'artist_name': 'Guns N Petals',
+            'start_time': '2035-04-01T20:00:00'
+        })
+        result = runner.invoke(args=['data', 'export', 'artists', '-', '--format', 'csv'])
+        self.assertIn('Guns N Petals,San Francisco,CA,,,,"Jazz,Rock n Roll",,True', result.output)
+
+    def test_bulk_import_rejects_unknown_venue(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shows_path = os.path.join(directory, 'shows.jsonl')
+        with open(shows_path, 'w') as file:
+            file.write(json.dumps({'venue_name': 'Nowhere', 'artist_name': 'Nobody', 'start_time': '2035-04-01'}) + '\n')
+        result = app.test_cli_runner().invoke(args=['data', 'import', 'shows', shows_path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('Unknown venue or artist', result.output)
+
+    def test_bulk_import_clears_page_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        venues_path = os.path.join(directory, 'venues.jsonl')
+        with open(venues_path, 'w') as file:
+            file.write(json.dumps({
+                'name': 'Imported Venue', 'city': 'Austin', 'state': 'TX', 'address': '1 Congress Ave',
+                'phone': '512-000-1234', 'facebook_link': 'https://www.facebook.com/ImportedVenue'
+            }) + '\n')
+        self.assertNotIn('Imported Venue', self.client().get('/venues').get_data(as_text=True))
+
+        result = app.test_cli_runner().invoke(args=['data', 'import', 'venues', venues_path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported Venue', self.client().get('/venues').get_data(as_text=True))
+
+    def test_cached_page_skips_the_database(self):
+        self.seed(2)
+        self.assertGreater(self.count_statements('/venues/1'), 0)
+        self.statements = []
+        res = self.client().get('/venues/1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.statements, [])
+        self.assertEqual(page_cache.stats()['hits'], 1)
+
+    def test_edit_venue_invalidates_affected_pages(self):
+        self.seed(2)
+        for path in ('/venues', '/venues/1', '/venues/2', '/artists/1'):
+            self.client().get(path)
+        res = self.client().post('/venues/1/edit', json={
+            'name': 'The Musical Hop',
+            'city': 'City 0',
+            'state': 'CA',
+            'phone': '555-555-5555',
+            'genres': 'Jazz',
+            'facebook-link': 'https://www.facebook.com/venue0'
+        })
+        self.assertEqual(res.status_code, 200)
+        db.session.remove()
+        with app.test_client() as client:
+            # Drop the flashed message so the pages are served from the cache
+            with client.session_transaction() as session:
+                session.pop('_flashes', None)
+            self.assertIn('The Musical Hop', client.get('/venues').get_data(as_text=True))
+            self.assertIn('The Musical Hop', client.get('/artists/1').get_data(as_text=True))
+            misses = page_cache.stats()['misses']
+            client.get('/venues/2')
+            self.assertEqual(page_cache.stats()['misses'], misses)
+
+    def test_delete_invalidates_counterpart_pages(self):
+        self.seed(2)
+        for deleted, counterpart in (('/venues/1', '/artists/1'), ('/artists/1', '/venues/2')):
+            self.client().get(counterpart)
+            res = self.client().delete(deleted)
+            self.assertEqual(res.status_code, 200)
+            db.session.remove()
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session.pop('_flashes', None)
+                # Rendered again, rather than served with the deleted rows
+                misses = page_cache.stats()['misses']
+                client.get(counterpart)
+                self.assertEqual(page_cache.stats()['misses'], misses + 1, deleted)
+
+    def test_clear_keeps_stats(self):
+        self.seed(1)
+        self.client().get('/venues')
+        self.client().get('/venues')
+        page_cache.clear()
+        self.assertEqual((page_cache.stats()['hits'], page_cache.stats()['misses']), (1, 1))
+        self.assertEqual(page_cache.stats()['entries'], 0)
+        page_cache.reset_stats()
+        self.assertEqual(page_cache.stats()['hits'], 0)
+
+    def test_lru_cache_evicts_and_expires(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 'A', 60)
+        cache.set('b', 'B', 60)
+        cache.get('a')
+        cache.set('c', 'C', 60)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D', 0)
+        self.assertIsNone(cache.get('d'))
+
+    def test_shared_cache_backend(self):
+        shared = PageCache(SharedCache(FakeRedis()), ttl=60)
+        other_worker = PageCache(SharedCache(shared.backend.client), ttl=60)
+        render = shared.cached('venue:{venue_id}')(lambda venue_id: 'page {}'.format(venue_id))
+        with app.test_request_context():
+            self.assertEqual(render(venue_id=1), 'page 1')
+            self.assertEqual(other_worker.backend.get('venue:1'), 'page 1')
+            other_worker.invalidate('venue:1')
+            self.assertIsNone(shared.backend.get('venue:1'))
+        self.assertEqual(shared.stats()['misses'], 1)
+
+    def test_format_datetime_matches_babel(self):
+        value = datetime(2035, 4, 1, 20, 30)
+        for format, pattern in (('full', "EEEE MMMM, d, y 'at' h:mma"), ('medium', 'EE MM, dd, y h:mma'), ('yyyy-MM-dd', 'yyyy-MM-dd')):
+            expected = babel.dates.format_datetime(value, pattern, locale='en_US')
+            self.assertEqual(format_datetime(value, format), expected)
+            self.assertEqual(format_datetime('2035-04-01 20:30:00', format), expected)
+        self.assertEqual(format_datetime('April 1 2035 8:30pm', 'yyyy-MM-dd HH:mm'), '2035-04-01 20:30')
+        self.assertEqual(format_datetime(value, 'EEEE', locale='fr_FR'), 'dimanche')
+        self.assertEqual(format_datetimes([value, value], 'short'), [babel.dates.format_datetime(value, 'short', locale='en_US')] * 2)
+
+    def test_metrics_record_endpoint_timings(self):
+        self.assertEqual(self.client().get('/metrics').status_code, 404)
+        app.config['INSTRUMENTATION_ENABLED'] = True
+        instrumentation.reset()
+        self.seed(2)
+        res = self.client().get('/venues/1')
+        self.assertEqual(res.headers['X-Query-Count'], '2')
+        metrics = self.client().get('/metrics').get_json()
+        stats = metrics['endpoints']['show_venue']
+        self.assertEqual(stats['requests'], 1)
+        self.assertEqual(stats['sql_statements'], 2)
+        self.assertGreater(stats['template_seconds'], 0)
+        self.assertEqual(sum(bucket['count'] for bucket in stats['latency_histogram']), 1)
+        self.assertEqual(stats['over_query_budget'], 0)
+
+    def test_requests_over_query_budget_are_flagged(self):
+        app.config['INSTRUMENTATION_ENABLED'] = True
+        app.config['QUERY_BUDGET'] = 1
+        instrumentation.reset()
+        self.seed(2)
+        with self.assertLogs(app.logger, level='WARNING') as logs:
+            self.client().get('/artists/1')
+        self.assertIn('/artists/1 issued 2 SQL statements, over the budget of 1', logs.output[0])
+        self.assertEqual(instrumentation.snapshot()['show_artist']['over_query_budget'], 1)
+
+    def test_show_venue_splits_past_and_upcoming_shows(self):
+        self.seed(1, shows_per_venue=3)
+        res = self.client().get('/venues/1')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('2 Upcoming Shows', body)
+        self.assertIn('1 Past Show', body)
+        self.assertIn('<span class="genre">Folk</span>', body)
+
+    def test_show_artist_splits_past_and_upcoming_shows(self):
+        self.seed(2, shows_per_venue=3)
+        res = self.client().get('/artists/1')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('4 Upcoming Shows', body)
+        self.assertIn('2 Past Shows', body)
+
+    def test_detail_pages_query_count_is_constant(self):
+        self.seed(1, shows_per_venue=2)
+        venue_page = self.count_statements('/venues/1')
+        artist_page = self.count_statements('/artists/1')
+        self.assertLessEqual(venue_page, 2)
+        self.assertLessEqual(artist_page, 2)
+        self.seed(20, shows_per_venue=10)
+        self.assertEqual(self.count_statements('/venues/1'), venue_page)
+        self.assertEqual(self.count_statements('/artists/1'), artist_page)
+
+    def test_healthz(self):
+        res = self.client().get('/healthz')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['status'], 'ok')
+        self.assertEqual(data['pool'], 'StaticPool')
+
+    def test_engine_options(self):
+        config = {'DB_POOL_SIZE': 20, 'DB_STATEMENT_TIMEOUT': 5000}
+        options = engine_options(config, 'postgresql://localhost/fyyur')
+        self.assertIs(options['poolclass'], MonitoredQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        self.assertEqual(engine_options(config, 'sqlite://'), {})
+
+    @unittest.skipUnless(importlib.util.find_spec('psycopg2'), 'needs psycopg2')
+    def test_engine_uses_monitored_pool(self):
+        # Configured as app.py configures the app, for a PostgreSQL database
+        other = Flask(__name__)
+        other.config.from_object('config')
+        other.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(other.config, other.config['SQLALCHEMY_DATABASE_URI'])
+        db.init_app(other)
+        with other.app_context():
+            self.assertIsInstance(db.engine.pool, MonitoredQueuePool)
+            self.assertEqual(db.engine.pool.size(), other.config['DB_POOL_SIZE'])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+'''
+Benchmarks for the trivia API.
+
+Seeds a throwaway database with a generated corpus of increasing numbers of
+questions and reports the latency of quiz turns, question pages and searches,
+or of every route. Given a baseline file, exits with an error when a result
+issues more SQL statements than its baseline, or is slower than latencies
+saved with --timings on the same machine. Uses an in-memory
+SQLite database unless BENCHMARK_DATABASE_URL points elsewhere.
+
+    python benchmarks.py routes --sizes 1000 10000 --baseline perf_baseline.json
+    python benchmarks.py quiz --sizes 1000 10000 100000 1000000
+    python benchmarks.py sessions --sizes 100000
+    python benchmarks.py questions --sizes 1000 100000 1000000
+    BENCHMARK_DATABASE_URL=postgresql://localhost/trivia_bench python benchmarks.py search --sizes 1000000
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from sqlalchemy import event
+from sqlalchemy.sql.expression import func
+
+from flaskr import create_app
+from models import db, Question, Category
+
+BATCH_SIZE = 10000
+CATEGORIES = ('Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports')
+
+
+# Question text is drawn from these words, the first ones far more often
+WORDS = (
+  'which', 'what', 'who', 'year', 'country', 'river', 'element', 'painter', 'album', 'team',
+  'first', 'largest', 'capital', 'famous', 'title', 'planet', 'novel', 'war', 'invented', 'won',
+  'ocean', 'mountain', 'symphony', 'dynasty', 'molecule', 'galaxy', 'sculpture', 'olympics', 'treaty', 'volcano',
+  'zebrafish', 'quasar', 'fresco', 'isotope', 'marathon', 'sonnet', 'glacier', 'pharaoh', 'cricket', 'opera',
+)
+
+
+def question_text(rng, words):
+  # A question of five to twelve words and an answer of one to three
+  question = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 12))).capitalize() + '?'
+  answer = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3))).title()
+  return question, answer
+
+
+def seed_questions(num_questions, seed=0):
+  '''
+  Inserts the six categories and a reproducible corpus of num_questions
+  questions spread evenly over them
+  '''
+  rng = random.Random(seed)
+  # Weight common words so that searches match a realistic spread of rows
+  words = [word for i, word in enumerate(WORDS) for _ in range(len(WORDS) // (i + 1) + 1)]
+  # Categories go through the ORM, whose events refresh the app's cached copies
+  db.session.add_all([Category(type) for type in CATEGORIES])
+  db.session.flush()
+  # Bulk insert questions directly rather than through the ORM unit of work
+  for start in range(0, num_questions, BATCH_SIZE):
+    stop = min(start + BATCH_SIZE, num_questions)
+    rows = []
+    for i in range(start, stop):
+      question, answer = question_text(rng, words)
+      rows.append({
+        'question': question,
+        'answer': answer,
+        'category': i % len(CATEGORIES) + 1,
+        'difficulty': i % 5 + 1
+      })
+    db.session.execute(Question.__table__.insert(), rows)
+  db.session.commit()
+
+
+def play(client, quiz_category, turns):
+  '''
+  Plays turns of a quiz and returns the time of the first turn and the
+  median time of the rest
+  '''
+  previous_questions = []
+  timings = []
+  for _ in range(turns):
+    start = time.perf_counter()
+    res = client.post('/quizzes/1/play', json={
+      'quiz_category': quiz_category,
+      'previous_questions': previous_questions
+    })
+    timings.append(time.perf_counter() - start)
+    assert res.status_code == 200, res.status_code
+    previous_questions.append(res.get_json()['question']['id'])
+  rest = sorted(timings[1:])
+  return timings[0], rest[len(rest) // 2]
+
+
+def legacy_turn():
+  # The question selection as it was before flaskr/quiz.py
+  return Question.query.order_by(func.random()).all()[0]
+
+
+def bench_quiz(app, size, legacy_max):
+  seed_questions(size)
+  client = app.test_client()
+  results = []
+  for label, quiz_category in (('all categories', {'type': 'click', 'id': 0}), ('one category', {'type': 'Science', 'id': '0'})):
+    first, turn = play(client, quiz_category, 10)
+    results.append((label + ', first turn', first, None))
+    results.append((label + ', next turns', turn, None))
+  if size <= legacy_max:
+    start = time.perf_counter()
+    legacy_turn()
+    results.append(('legacy order_by(random())', time.perf_counter() - start, None))
+  return results
+
+
+def bench_sessions(app, size, legacy_max, sessions=200, turns=50):
+  '''
+  Interleaves turns of many long quizzes, comparing session turns against
+  resending previous_questions, at the first and the last turn
+  '''
+  seed_questions(size)
+  client = app.test_client()
+  quiz_category = {'type': 'click', 'id': 0}
+  games = []
+  for _ in range(sessions):
+    res = client.post('/quizzes', json={'quiz_category': quiz_category})
+    games.append((res.get_json()['quiz_session'], [res.get_json()['question']['id']]))
+  timings = {}
+  for turn in range(1, turns):
+    for session_id, previous_questions in games:
+      for label, body in (
+        ('session', {'quiz_session': session_id}),
+        ('previous_questions', {'quiz_category': quiz_category, 'previous_questions': previous_questions})
+      ):
+        start = time.perf_counter()
+        res = client.post('/quizzes/1/play', json=body)
+        timings.setdefault((label, turn), []).append(time.perf_counter() - start)
+        assert res.status_code == 200, res.status_code
+        question_id = res.get_json()['question']['id']
+      previous_questions.append(question_id)
+  results = []
+  for label in ('session', 'previous_questions'):
+    for turn in (1, turns - 1):
+      samples = sorted(timings[(label, turn)])
+      results.append(('{}, turn {}'.format(label, turn), samples[len(samples) // 2], None))
+  return results
+
+
+def measure(client, path, repeat=3):
+  '''
+  Returns the best wall-clock time and the number of SQL statements
+  issued for a GET request to path
+  '''
+  statements = []
+
+  def record_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  best = None
+  event.listen(db.engine, 'before_cursor_execute', record_statement)
+  try:
+    for _ in range(repeat):
+      del statements[:]
+      start = time.perf_counter()
+      res = client.get(path)
+      elapsed = time.perf_counter() - start
+      assert res.status_code == 200, res.status_code
+      best = elapsed if best is None else min(best, elapsed)
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', record_statement)
+  return best, len(statements)
+
+
+def bench_questions(app, size, legacy_max):
+  seed_questions(size)
+  client = app.test_client()
+  last_page = max(size // 10, 1)
+  deep_cursor = db.session.query(Question.id).order_by(Question.id).offset((last_page - 1) * 10).limit(1).scalar() - 1
+  return [
+    ('GET /questions?page=1',) + measure(client, '/questions?page=1'),
+    ('GET /questions last page by offset',) + measure(client, '/questions?page={}'.format(last_page)),
+    ('GET /questions last page by cursor',) + measure(client, '/questions?after={}'.format(deep_cursor)),
+    ('GET /questions, 1000 a page',) + measure(client, '/questions?page=2&per_page=1000'),
+  ]
+
+
+def bench_search(app, size, legacy_max, requests=20):
+  '''
+  Sends a mix of common, rare and partial word searches, with and without
+  filters, and reports the median and 95th percentile latency of each
+  '''
+  seed_questions(size)
+  client = app.test_client()
+  searches = (
+    ('common word', {'searchTerm': 'capital'}),
+    ('rare word', {'searchTerm': 'zebrafish'}),
+    ('partial word', {'searchTerm': 'glaci'}),
+    ('filtered, page 5', {'searchTerm': 'river', 'category': 2, 'difficulty': 3, 'page': 5}),
+  )
+  results = []
+  for label, body in searches:
+    timings = []
+    for _ in range(requests):
+      start = time.perf_counter()
+      res = client.post('/questions/search', json=body)
+      timings.append(time.perf_counter() - start)
+      assert res.status_code == 200, res.status_code
+    timings.sort()
+    results.append((label + ', median', timings[len(timings) // 2], None))
+    results.append((label + ', p95', timings[int(len(timings) * 0.95) - 1], None))
+  return results
+
+
+def measure_route(client, method, path, body=None, status=200, requests=50, rounds=3):
+  '''
+  Returns the 95th percentile latency and the most SQL statements issued
+  over requests calls of a route, after one call to warm its caches. The
+  lowest p95 of several rounds is kept, so that a pause of the machine does
+  not read as a regression. path and body may be functions, called for each
+  request.
+  '''
+  statements = []
+
+  def record_statement(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  best = None
+  most_statements = 0
+  for round in range(rounds):
+    timings = []
+    for i in range(requests + (round == 0)):
+      request_path = path() if callable(path) else path
+      request_body = body() if callable(body) else body
+      del statements[:]
+      event.listen(db.engine, 'before_cursor_execute', record_statement)
+      try:
+        start = time.perf_counter()
+        res = client.open(request_path, method=method, json=request_body)
+        elapsed = time.perf_counter() - start
+      finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+      assert res.status_code == status, (method, request_path, res.status_code)
+      if round or i:
+        timings.append(elapsed)
+        most_statements = max(most_statements, len(statements))
+    timings.sort()
+    p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+    best = p95 if best is None else min(best, p95)
+  return best, most_statements
+
+
+def bench_routes(app, size, legacy_max):
+  '''
+  Measures every route of the API: the p95 latency and the most SQL
+  statements of each
+  '''
+  seed_questions(size)
+  client = app.test_client()
+  last_page = max(size // 10, 1)
+  deep_cursor = db.session.query(Question.id).order_by(Question.id).offset((last_page - 1) * 10).limit(1).scalar() - 1
+  # Delete questions from the end, so that the pages above are unchanged
+  deletable = db.session.query(Question.id).order_by(Question.id.desc()).limit(200).all()
+  etag = client.get('/categories').headers['ETag']
+  session_id = client.post('/quizzes', json={'quiz_category': {'type': 'Science', 'id': '0'}}).get_json()['quiz_session']
+  previous_questions = []
+
+  def next_deleted():
+    return '/questions/{}/delete'.format(deletable.pop()[0])
+
+  def quiz_turn():
+    return {'quiz_category': {'type': 'click', 'id': 0}, 'previous_questions': previous_questions}
+
+  new_question = {'question': 'New question?', 'answer': 'New answer', 'difficulty': 1, 'category': '0'}
+  bulk_questions = [dict(new_question, category=1) for _ in range(100)]
+  cases = (
+    ('GET /categories', 'GET', '/categories', None, 200),
+    ('GET /categories, not modified', 'GET', '/categories', None, 304),
+    ('GET /questions?page=1', 'GET', '/questions?page=1', None, 200),
+    ('GET /questions last page by offset', 'GET', '/questions?page={}'.format(last_page), None, 200),
+    ('GET /questions last page by cursor', 'GET', '/questions?after={}'.format(deep_cursor), None, 200),
+    ('GET /categories/1/questions', 'GET', '/categories/1/questions', None, 200),
+    ('POST /questions/search', 'POST', '/questions/search', {'searchTerm': 'capital'}, 200),
+    ('POST /questions/search, filtered', 'POST', '/questions/search', {'searchTerm': 'river', 'category': 2, 'difficulty': 3}, 200),
+    ('GET /questions, 1000 a page', 'GET', '/questions?per_page=1000', None, 200),
+    ('POST /questions/search, 1000 a page', 'POST', '/questions/search', {'searchTerm': 'capital', 'per_page': 1000}, 200),
+    ('POST /quizzes', 'POST', '/quizzes', {'quiz_category': {'type': 'click', 'id': 0}}, 200),
+    ('POST /quizzes/1/play, session', 'POST', '/quizzes/1/play', {'quiz_session': session_id}, 200),
+    ('POST /quizzes/1/play, previous', 'POST', '/quizzes/1/play', quiz_turn, 200),
+    ('POST /questions/create', 'POST', '/questions/create', new_question, 200),
+    ('POST /questions/bulk, 100 rows', 'POST', '/questions/bulk', bulk_questions, 200),
+    ('DELETE /questions/<id>/delete', 'DELETE', next_deleted, None, 200),
+  )
+  results = []
+  for label, method, path, body, status in cases:
+    if status == 304:
+      client.environ_base['HTTP_IF_NONE_MATCH'] = etag
+    try:
+      results.append((label,) + measure_route(client, method, path, body, status))
+    finally:
+      client.environ_base.pop('HTTP_IF_NONE_MATCH', None)
+  return results
+
+
+def check_baseline(baseline, key, elapsed, statements, tolerance):
+  '''
+  Returns why a result regressed from its baseline, or None. Latency is only
+  compared when the baseline has one, and may exceed it by the tolerance,
+  plus 5ms for timer noise.
+  '''
+  expected = baseline.get(key)
+  if expected is None:
+    return None
+  if statements is not None and expected.get('statements') is not None and statements > expected['statements']:
+    return '{} statements, baseline {}'.format(statements, expected['statements'])
+  if expected.get('seconds') is not None and elapsed > expected['seconds'] * (1 + tolerance) + 0.005:
+    return '{:.4f}s, baseline {:.4f}s'.format(elapsed, expected['seconds'])
+  return None
+
+
+BENCHMARKS = {
+  'routes': bench_routes,
+  'quiz': bench_quiz,
+  'sessions': bench_sessions,
+  'questions': bench_questions,
+  'search': bench_search,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the trivia API at increasing scale.')
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+  parser.add_argument('--legacy-max', type=int, default=100000, help='Largest size to time the previous implementation at.')
+  parser.add_argument('--baseline', help='Fail when a result regresses from this baseline file.')
+  parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed latency increase over the baseline, as a fraction.')
+  parser.add_argument('--save-baseline', help='Write the statement counts to this baseline file.')
+  parser.add_argument('--timings', action='store_true', help='Also save latencies, for baselines compared on this machine only.')
+  args = parser.parse_args()
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as file:
+      baseline = json.load(file)
+  results = {}
+  regressions = []
+  database_path = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite://')
+  print('{:>10} {:<36} {:>12} {:>12}'.format('size', 'case', 'seconds', 'statements'))
+  for size in args.sizes:
+    # A new app for each size, so that nothing is cached between sizes
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+    with app.app_context():
+      db.drop_all()
+      db.create_all()
+      for label, elapsed, statements in BENCHMARKS[args.benchmark](app, size, args.legacy_max):
+        key = '{}/{}/{}'.format(args.benchmark, size, label)
+        # Latencies depend on the machine, so they are left out of baselines
+        # shared between machines
+        results[key] = {'statements': statements}
+        if args.timings:
+          results[key]['seconds'] = elapsed
+        regression = check_baseline(baseline, key, elapsed, statements, args.tolerance)
+        print('{:>10} {:<36} {:>12.4f} {:>12}{}'.format(
+          size, label, elapsed, '' if statements is None else statements,
+          '  REGRESSED: ' + regression if regression else ''
+        ))
+        if regression:
+          regressions.append(key)
+      db.session.remove()
+      db.drop_all()
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as file:
+      json.dump(results, file, indent=2, sort_keys=True)
+      file.write('\n')
+  if regressions:
+    sys.exit('{} of {} results regressed from {}'.format(len(regressions), len(results), args.baseline))
+
+
+if __name__ == '__main__':
+  main()
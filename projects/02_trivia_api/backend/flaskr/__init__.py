@@ -2,20 +2,81 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from  sqlalchemy.sql.expression import func, select
+from sqlalchemy.exc import SQLAlchemyError
 from flask_cors import CORS
 import random
 import json
+import hashlib
 from requests.models import Response
+import io
 import sys
+from collections import OrderedDict
 
 from models import db, setup_db, Question, Category
+from pool import pool_health
+from .bulk import import_questions, questions_cli, read_rows, validate_question
+from .cache import CachedValue
+from .quiz import QuestionSampler, QuizSessions, category_at, quiz_category_id
+from .search import search_questions
+from .serialize import JSONSerializer, fetch_question_rows
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 1000
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  # Settings such as DB_POOL_SIZE come from the file TRIVIA_SETTINGS names
+  app.config.from_envvar('TRIVIA_SETTINGS', silent=True)
+  app.config.update(test_config or {})
+  if 'SQLALCHEMY_DATABASE_URI' in app.config:
+    setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+  else:
+    setup_db(app)
+  app.cli.add_command(questions_cli)
+  # Encodes the question listings, with json unless JSON_MODULE names another
+  serializer = JSONSerializer(app.config.get('JSON_MODULE', 'json'))
+
+  @app.cli.command('create-tables')
+  def create_tables_command():
+    '''Create the database tables and indexes that do not exist yet.'''
+    db.create_all()
+
+  # Random question picker for quizzes, kept in step with question changes
+  sampler = QuestionSampler()
+  quiz_sessions = QuizSessions(
+    sampler,
+    ttl=app.config.get('QUIZ_SESSION_TTL', 1800),
+    max_sessions=app.config.get('QUIZ_SESSION_MAX', 10000)
+  )
+
+  # Category names by id, and the number of questions in each category, read
+  # once and kept until they change. Category caches expire as soon as the
+  # copies clients keep of /categories, so that neither outlives the other
+  categories_max_age = app.config.get('CATEGORIES_MAX_AGE', 60)
+  categories = CachedValue(lambda: OrderedDict(
+    db.session.query(Category.id, Category.type).order_by(Category.id)
+  ), ttl=categories_max_age)
+  categories.invalidate_on_change(Category)
+  # Counted from the category index, rather than from the table
+  question_counts = CachedValue(lambda: dict(
+    db.session.query(Question.category, func.count()).group_by(Question.category)
+  ), ttl=60)
+  question_counts.invalidate_on_change(Question)
+
+  def serialize_categories():
+    # The /categories response body and its ETag
+    body = json.dumps({"categories": list(categories.get().values())}).encode('utf-8')
+    return body, hashlib.sha256(body).hexdigest()
+
+  categories_snapshot = CachedValue(serialize_categories, ttl=categories_max_age)
+  categories_snapshot.invalidate_on_change(Category)
+  try:
+    with app.app_context():
+      categories_snapshot.get()
+  except SQLAlchemyError:
+    # The database is not ready yet; the snapshot is built on the first request
+    print(sys.exc_info())
   
   '''
   Set up CORS. Allow '*' for origins.
@@ -38,20 +99,22 @@ def create_app(test_config=None):
   Create an endpoint to handle GET requests 
   for all available categories.
   '''
+  @app.route('/healthz', methods = ['GET'])
+  def healthz():
+    # Pool usage and checkout waits, and whether the database answers
+    health = pool_health(db.engine)
+    health['status'] = 'ok' if health['database'] == 'ok' else 'unavailable'
+    return jsonify(health), 200 if health['status'] == 'ok' else 503
+
   @app.route('/categories', methods = ['GET'])
   def get_all_categories():
-    categories = Category.query.all()
-    categories_list = []
-    result = {}
-    for category in categories:
-      categories_list.append(category.type)
-    result.update(
-      {
-        "categories": categories_list
-      }
-    )
-    result_json = jsonify(result)
-    return result_json
+    body, etag = categories_snapshot.get()
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = categories_max_age
+    # Answers If-None-Match with 304 Not Modified when the ETag matches
+    return response.make_conditional(request)
 
   '''
   Create an endpoint to handle GET requests for questions, 
@@ -64,42 +127,56 @@ def create_app(test_config=None):
   ten questions per page and pagination at the bottom of the screen for three pages.
   Clicking on the page numbers should update the questions. 
   '''
+  def page_size(value):
+    # The number of questions a page was asked for, ten by default
+    per_page = int(value or QUESTIONS_PER_PAGE)
+    if not 1 <= per_page <= app.config.get('MAX_QUESTIONS_PER_PAGE', MAX_QUESTIONS_PER_PAGE):
+      raise ValueError(per_page)
+    return per_page
+
+  def paginate_questions(query, total):
+    '''
+    Returns the page of question rows of query chosen by the request's page
+    or after argument, and the id to continue after, or None on the last page
+    '''
+    try:
+      page_number = int(request.args.get('page') or 1)
+      after = int(request.args['after']) if request.args.get('after') else None
+      per_page = page_size(request.args.get('per_page'))
+    except ValueError:
+      abort(400)
+    if page_number < 1:
+      abort(400)
+    query = query.order_by(Question.id)
+    if after is not None:
+      # Keyset pagination seeks past the last id seen rather than skipping rows,
+      # so deep pages cost the same as the first
+      rows = fetch_question_rows(query.filter(Question.id > after).limit(per_page + 1))
+      has_next_page = len(rows) > per_page
+      rows = rows[:per_page]
+    else:
+      offset = (page_number - 1) * per_page
+      rows = fetch_question_rows(query.limit(per_page).offset(offset))
+      has_next_page = offset + len(rows) < total
+    return rows, rows[-1].id if has_next_page else None
+
   @app.route('/questions', methods = ['GET'])
   def get_questions():
-    result = {}
-    page_number_string = request.args.get('page')
-    if page_number_string:
-      page_number = int(page_number_string)
-    else:
-      page_number = 1
-    questions = Question.query.paginate(page=page_number, error_out=False, max_per_page=10)
-    questions_object = []
-    for question in questions.items:
-      questions_object.append(
-        {
-          "id": question.id,
-          "question": question.question,
-          "answer": question.answer,
-          "category": question.category,
-          "difficulty": question.difficulty
-        }
-      )
-    questions_count = Question.query.count()
-    categories = Category.query.all()
-    # Add placeholder at zero-index since categories are not (but should be) zero-indexed in database
-    categories_object = ['']
-    for category in categories:
-      categories_object.append(category.type)
-    first_question = Question.query.first()
-    first_question_category = first_question.category
-    result.update({
-      "questions": questions_object,
+    # Counting every question is as slow as reading them, so the counts are cached
+    questions_count = sum(question_counts.get().values())
+    rows, next_cursor = paginate_questions(Question.query, questions_count)
+    # Category names indexed by their ids, with placeholders for ids not in use
+    category_map = categories.get()
+    categories_object = [''] * (max(category_map, default=0) + 1)
+    for category_id, category_type in category_map.items():
+      categories_object[category_id] = category_type
+    result = {
       "total_questions": questions_count,
       "categories": categories_object,
-      "current_category": first_question_category
-    })
-    response_json = jsonify(result)
-    return response_json
+      "current_category": rows[0].category if rows else None,
+      "next_cursor": next_cursor
+    }
+    return serializer.questions_response(app, result, rows)
   
   '''
   Create an endpoint to DELETE a question using a question ID. 
@@ -114,8 +191,10 @@ def create_app(test_config=None):
     try:
       question = Question.query.get(id)
       question_id = question.id
+      category_id = question.category
       db.session.delete(question)
       db.session.commit()
+      sampler.remove(question_id, category_id)
     except:
       error = True
       db.session.rollback()
@@ -146,16 +225,29 @@ def create_app(test_config=None):
   def create_question():
     error = False
     response = {}
+    body = request.get_json(silent=True)
+    category_map = categories.get()
+    try:
+      # The frontend sends the category's position in the /categories list.
+      # The question is then checked as each row of a bulk load is
+      category_id = category_at(list(category_map), body['category'])
+      new_q_content, new_answer, new_category, new_difficulty = validate_question(
+        dict(body, category=category_id),
+        category_map
+      )
+    except IndexError:
+      abort(422)
+    except (KeyError, TypeError, ValueError):
+      print(sys.exc_info())
+      abort(400)
     try:
-      new_q_content = request.get_json()['question']
-      new_answer = request.get_json()['answer']
-      new_difficulty = request.get_json()['difficulty']
-      new_category_raw = (request.get_json()['category'])
-      # Increment category by one to account for non-zero indexing in starter code
-      new_category = (int(new_category_raw) + 1)
       new_question = Question(question=new_q_content, answer=new_answer, difficulty=new_difficulty, category=new_category)
       db.session.add(new_question)
+      # Flushed for its id, which would be reloaded once the commit expires it
+      db.session.flush()
+      question_id = new_question.id
       db.session.commit()
+      sampler.add(question_id, new_category)
     except:
       error = True
       db.session.rollback()
@@ -173,6 +265,45 @@ def create_app(test_config=None):
       response_json = jsonify(response)
       return response_json
 
+  @app.route('/questions/bulk', methods = ['POST'])
+  def bulk_create_questions():
+    # Accepts a JSON array, JSON Lines or CSV, chosen by the Content-Type
+    if request.mimetype == 'application/json':
+      body = request.get_json(silent=True)
+      if isinstance(body, dict):
+        body = body.get('questions')
+      if not isinstance(body, list):
+        abort(400)
+      rows = enumerate(body, 1)
+    elif request.mimetype in ('application/x-ndjson', 'application/jsonl', 'text/csv'):
+      stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+      rows = read_rows(stream, 'csv' if request.mimetype == 'text/csv' else 'jsonl')
+    else:
+      abort(400)
+
+    def batch_imported(category_ids):
+      # Core inserts return no ids and bypass the ORM events that keep these
+      # up to date, so the categories inserted into are reloaded once each
+      # batch is committed
+      sampler.invalidate(category_ids)
+      question_counts.invalidate()
+
+    try:
+      imported, failed, errors = import_questions(
+        rows,
+        app.config.get('BULK_BATCH_SIZE', 10000),
+        committed=batch_imported
+      )
+    except UnicodeDecodeError:
+      abort(400)
+    response = {
+      "success": True,
+      "imported": imported,
+      "failed": failed,
+      "errors": errors
+    }
+    return jsonify(response)
+
   '''
   Create a POST endpoint to get questions based on a search term. 
   It should return any questions for whom the search term 
@@ -184,35 +315,27 @@ def create_app(test_config=None):
   '''
   @app.route('/questions/search', methods = ['POST'])
   def get_search_results():
-    error = False
-    response = {}
     try:
-      search_term = request.get_json()['searchTerm']
-      matches = Question.query.filter(Question.question.ilike('%' + search_term + '%')).all()
-      matches_list = []
-      for match in matches:
-        matches_list.append(
-          {
-            "id": match.id,
-            "question": match.question,
-            "answer": match.answer,
-            "category": match.category,
-            "difficulty": match.difficulty
-          }
-        )
-      response.update(
-        {
-          "questions": matches_list 
-        }
-      )
-    except:
-      error = True
+      body = request.get_json()
+      search_term = body['searchTerm']
+      page_number = int(body.get('page') or 1)
+      category = body.get('category')
+      category = int(category) if category is not None else None
+      difficulty = body.get('difficulty')
+      difficulty = int(difficulty) if difficulty is not None else None
+      per_page = page_size(body.get('per_page'))
+      if not isinstance(search_term, str) or page_number < 1:
+        raise ValueError(search_term)
+    except (AttributeError, KeyError, TypeError, ValueError):
       print(sys.exc_info())
-    if error:
       abort(400)
-    else:
-      response_json = jsonify(response)
-      return response_json
+    rows, total = search_questions(search_term, page_number, per_page, category, difficulty)
+    response = {
+      "total_questions": total,
+      "current_category": category,
+      "page": page_number
+    }
+    return serializer.questions_response(app, response, rows)
 
   '''
   Create a GET endpoint to get questions based on category. 
@@ -223,34 +346,16 @@ def create_app(test_config=None):
   '''
   @app.route('/categories/<int:category_id>/questions', methods = ['GET'])
   def get_category_questions(category_id):
-    error = False
-    result = {}
-    try:
-      category_questions = Question.query.filter_by(category = category_id)
-      questions_list = []
-      for question_object in category_questions:
-        questions_list.append(
-          {
-            "id": question_object.id,
-            "question": question_object.question,
-            "answer": question_object.answer,
-            "category": question_object.category,
-            "difficulty": question_object.difficulty
-          }
-        )
-      total_questions = Question.query.filter_by(id = category_id).count()
-      current_category = category_id
-      result.update({
-        "questions": questions_list,
-        "total_questions": total_questions,
-        "current_category": current_category
-      })
-    except:
-      error = True
-      abort(400)
-    finally:
-      response_object = jsonify(result)
-      return response_object
+    if category_id not in categories.get():
+      abort(404)
+    total_questions = question_counts.get().get(category_id, 0)
+    rows, next_cursor = paginate_questions(Question.query.filter(Question.category == category_id), total_questions)
+    result = {
+      "total_questions": total_questions,
+      "current_category": category_id,
+      "next_cursor": next_cursor
+    }
+    return serializer.questions_response(app, result, rows)
 
 
   '''
@@ -263,51 +368,52 @@ def create_app(test_config=None):
   one question at a time is displayed, the user is allowed to answer
   and shown whether they were correct or not. 
   '''
+  @app.route('/quizzes', methods = ['POST'])
+  def start_quiz():
+    # Starts a quiz session holding a shuffled deck of the category's questions,
+    # and deals its first question
+    try:
+      category_id = quiz_category_id(request.get_json().get('quiz_category'), list(categories.get()))
+    except IndexError:
+      abort(422)
+    except (AttributeError, TypeError, ValueError):
+      print(sys.exc_info())
+      abort(400)
+    session_id = quiz_sessions.start(category_id)
+    question = quiz_sessions.next_question(session_id)
+    response = {
+      "quiz_session": session_id,
+      "question": question.format() if question else None
+    }
+    return jsonify(response)
+
   @app.route('/quizzes/<int:quiz_id>/play', methods = ['POST'])
   def create_quiz(quiz_id):
-    error = False
-    response = {}
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and 'quiz_session' in body:
+      # Deal from the session's deck, which already excludes previous questions
+      try:
+        question = quiz_sessions.next_question(body['quiz_session'])
+      except (KeyError, TypeError):
+        abort(404)
+      return jsonify({"question": question.format() if question else None})
     try:
-      category_selected = request.get_json()['quiz_category']
-      category_id = category_selected['id']
-      excluded_questions = request.get_json()['previous_questions']
-      quiz_category = Category.query.get(category_id)
-      excluded_question_ids = []
-      for question in excluded_questions:
-        excluded_question_ids.append(question['id'])
-      # Get question list and randomize as informed by Stack Overflow question 60805, "Getting Random Row Through Sqlalchemy"
-      all_questions = Question.query.order_by(func.random()).all()
-      new_question_selected = False
-      question_dict = {}
-      for question in all_questions:
-        while new_question_selected == False:
-          if question.id in excluded_question_ids:
-            pass
-          elif question.id not in excluded_question_ids:
-            question_dict.update(
-              {
-                "id": question.id,
-                "question": question.question,
-                "answer": question.answer,
-                "category": question.category,
-                "difficulty": question.difficulty
-              }
-            )
-            response.update(
-              {
-                "question": question_dict
-              }
-            )
-            new_question_selected = True
-          else:
-            pass
-    except:
-      error = True
+      category_id = quiz_category_id(body.get('quiz_category'), list(categories.get()))
+      # Previous questions arrive as ids, or as question objects from older clients
+      excluded_question_ids = set(
+        question['id'] if isinstance(question, dict) else int(question)
+        for question in body.get('previous_questions', [])
+      )
+    except IndexError:
+      abort(422)
+    except (AttributeError, KeyError, TypeError, ValueError):
       print(sys.exc_info())
       abort(400)
-    finally:
-      response_object = jsonify(response)
-      return response_object
+    question = sampler.sample(category_id, excluded_question_ids)
+    response = {
+      "question": question.format() if question else None
+    }
+    return jsonify(response)
 
   '''
   Create error handlers for all expected errors 
@@ -319,9 +425,9 @@ def create_app(test_config=None):
       {
         "errorCode": 400,
         "message": "Sorry, something went wrong.",
-        "errorDetails": e
+        "errorDetails": e.description
       }
-    )
+    ), 400
 
   @app.errorhandler(403)
   def authorization_error(e):
@@ -330,7 +436,7 @@ def create_app(test_config=None):
         "errorCode": 403,
         "message": "Sorry, this request was not correctly authorized."
       }
-    )
+    ), 403
 
   @app.errorhandler(404)
   def resource_not_found(e):
@@ -339,7 +445,7 @@ def create_app(test_config=None):
           "errorCode": 404,
           "message": "Sorry, there's no page or resource at this location."
         }
-      )
+      ), 404
   
   @app.errorhandler(422)
   def unprocessable_request(e):
@@ -348,7 +454,7 @@ def create_app(test_config=None):
           "errorCode": 422,
           "message": "Sorry, this request is not valid for this resource."
         }
-      )
+      ), 422
   
   @app.errorhandler(500)
   def server_error(e):
@@ -357,7 +463,7 @@ def create_app(test_config=None):
           "errorCode": 500,
           "message": "Sorry, the server encountered an error in processing your request."
         }
-      )
+      ), 500
   
   return app
 
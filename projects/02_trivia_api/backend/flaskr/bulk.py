@@ -0,0 +1,231 @@
+'''
+Bulk loading of questions.
+
+    flask questions import questions.jsonl --batch-size 50000
+    flask questions load-fixture trivia.psql
+
+Questions are read from CSV or JSON Lines with the fields question, answer,
+category (a category id) and difficulty (1 to 5). Every row is validated,
+and invalid rows are reported by their line number without stopping the
+rest of the batch. Valid rows are written in chunked transactions with
+multi-row inserts, or COPY on PostgreSQL. The fixture loader reads the data
+of a pg_dump file such as trivia.psql without needing psql.
+'''
+import csv
+import io
+import json
+import re
+from itertools import islice
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db, Question, Category
+
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+DIFFICULTIES = range(1, 6)
+
+# At most this many row errors are listed; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+def file_format(path):
+  if path.endswith('.csv'):
+    return 'csv'
+  if path.endswith('.jsonl') or path.endswith('.json'):
+    return 'jsonl'
+  raise click.BadParameter('Expected a .csv or .jsonl file', param_hint='path')
+
+
+def read_rows(file, format):
+  '''
+  Yields (line number, row) pairs of a CSV or JSON Lines file, with rows that
+  cannot be parsed as the exception raised for them
+  '''
+  if format == 'csv':
+    reader = csv.DictReader(file)
+    for row in reader:
+      yield reader.line_num, row
+  else:
+    for line_number, line in enumerate(file, 1):
+      if line.strip():
+        try:
+          yield line_number, json.loads(line)
+        except ValueError as e:
+          yield line_number, e
+
+
+def batches(rows, batch_size):
+  rows = iter(rows)
+  while True:
+    batch = list(islice(rows, batch_size))
+    if not batch:
+      return
+    yield batch
+
+
+def validate_question(row, category_ids):
+  # Returns the (question, answer, category, difficulty) record of a row, or
+  # raises ValueError describing what is wrong with it
+  if isinstance(row, Exception):
+    raise ValueError('Invalid JSON: {}'.format(row))
+  if not isinstance(row, dict):
+    raise ValueError('Expected an object with the fields {}'.format(', '.join(FIELDS)))
+  record = []
+  for field in ('question', 'answer'):
+    value = row.get(field)
+    if not isinstance(value, str) or not value.strip():
+      raise ValueError('{} is required'.format(field))
+    record.append(value.strip())
+  for field in ('category', 'difficulty'):
+    try:
+      record.append(int(row.get(field)))
+    except (TypeError, ValueError):
+      raise ValueError('{} must be an integer'.format(field))
+  if record[2] not in category_ids:
+    raise ValueError('Unknown category {}'.format(record[2]))
+  if record[3] not in DIFFICULTIES:
+    raise ValueError('difficulty must be between 1 and 5')
+  return record
+
+
+def copy_rows(table, columns, rows):
+  # Streams rows into table with PostgreSQL's COPY through the session's connection
+  buffer = io.StringIO()
+  csv.writer(buffer).writerows(rows)
+  buffer.seek(0)
+  cursor = db.session.connection().connection.cursor()
+  cursor.copy_expert(
+    'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(table.name, ', '.join(columns)),
+    buffer
+  )
+
+
+def insert_rows(table, columns, rows):
+  if not rows:
+    return
+  if db.session.get_bind().dialect.name == 'postgresql':
+    copy_rows(table, columns, rows)
+  else:
+    db.session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def import_questions(rows, batch_size=10000, progress=None, committed=None):
+  '''
+  Validates and inserts (line number, row) pairs, committing every
+  batch_size rows, and returns the number imported, the number rejected and
+  the errors of the first MAX_REPORTED_ERRORS rejected rows. committed is
+  called with the set of category ids inserted into by each batch
+  '''
+  category_ids = set(id for (id,) in db.session.query(Category.id))
+  imported = 0
+  failed = 0
+  errors = []
+  for batch in batches(rows, batch_size):
+    records = []
+    for line_number, row in batch:
+      try:
+        records.append(validate_question(row, category_ids))
+      except ValueError as e:
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+          errors.append({"row": line_number, "error": str(e)})
+    insert_rows(Question.__table__, FIELDS, records)
+    db.session.commit()
+    imported += len(records)
+    if committed:
+      committed(set(record[2] for record in records))
+    if progress:
+      progress(imported, failed)
+  return imported, failed, errors
+
+
+COPY_STATEMENT = re.compile(r'^COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;$')
+
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+
+
+def unescape_copy_value(value):
+  # Decodes a field of COPY's text format, in which \N stands for NULL
+  if value == '\\N':
+    return None
+  return re.sub(r'\\(.)', lambda match: COPY_ESCAPES.get(match.group(1), match.group(1)), value)
+
+
+def read_dump_tables(file):
+  '''
+  Yields the table name, columns and rows of every COPY block of a pg_dump
+  file
+  '''
+  for line in file:
+    match = COPY_STATEMENT.match(line.rstrip('\n'))
+    if not match:
+      continue
+    columns = [column.strip() for column in match.group(2).split(',')]
+    rows = []
+    for line in file:
+      line = line.rstrip('\n')
+      if line == '\\.':
+        break
+      rows.append([unescape_copy_value(value) for value in line.split('\t')])
+    yield match.group(1), columns, rows
+
+
+def load_fixture(file):
+  '''
+  Loads the categories and questions of a pg_dump file, keeping their ids,
+  and returns the number of rows loaded for each table
+  '''
+  tables = {model.__tablename__: model.__table__ for model in (Category, Question)}
+  dump = dict((name, (columns, rows)) for name, columns, rows in read_dump_tables(file) if name in tables)
+  loaded = {}
+  # Categories first, since questions refer to them
+  for name in ('categories', 'questions'):
+    if name not in dump:
+      continue
+    columns, rows = dump[name]
+    insert_rows(tables[name], columns, rows)
+    loaded[name] = len(rows)
+    if db.session.get_bind().dialect.name == 'postgresql':
+      # Move the id sequence past the ids loaded
+      db.session.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), coalesce(max(id), 1)) FROM {0}".format(name)
+      ))
+  db.session.commit()
+  return loaded
+
+
+@click.group('questions')
+def questions_cli():
+  '''Bulk loading of trivia questions.'''
+
+
+@questions_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=10000, show_default=True, help='Rows per insert and commit.')
+@with_appcontext
+def import_command(path, batch_size):
+  '''Import questions from a CSV or JSON Lines file at PATH.'''
+  format = file_format(path)
+
+  def progress(imported, failed):
+    click.echo('{} questions imported, {} rejected'.format(imported, failed), err=True)
+
+  with open(path, newline='', encoding='utf-8') as file:
+    imported, failed, errors = import_questions(read_rows(file, format), batch_size, progress)
+  for error in errors:
+    click.echo('Row {row}: {error}'.format(**error), err=True)
+  click.echo('Imported {} questions, rejected {}'.format(imported, failed))
+
+
+@questions_cli.command('load-fixture')
+@click.argument('path', default='trivia.psql', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def load_fixture_command(path):
+  '''Load the categories and questions of a pg_dump file, trivia.psql by default.'''
+  with open(path, encoding='utf-8') as file:
+    loaded = load_fixture(file)
+  for name, count in loaded.items():
+    click.echo('Loaded {} {}'.format(count, name))
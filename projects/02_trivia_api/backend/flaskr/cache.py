@@ -0,0 +1,59 @@
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+
+CHANGE_EVENTS = ('after_insert', 'after_update', 'after_delete')
+
+# The cached values to invalidate on changes to each model. A single listener
+# per model serves every app's values, holding them weakly so that the values
+# of apps no longer in use are neither kept alive nor invalidated
+watchers = {}
+watchers_lock = threading.Lock()
+
+'''
+CachedValue
+    a value computed by load() and kept for ttl seconds, or until invalidated.
+    Used for small, rarely changing results such as the category list, so
+    that they are read once rather than on every request.
+'''
+class CachedValue(object):
+  def __init__(self, load, ttl=300):
+    self.load = load
+    self.ttl = ttl
+    self.value = None
+    self.expires_at = 0
+    self.lock = threading.Lock()
+
+  def get(self):
+    with self.lock:
+      if time.monotonic() >= self.expires_at:
+        self.value = self.load()
+        self.expires_at = time.monotonic() + self.ttl
+      return self.value
+
+  def invalidate(self):
+    with self.lock:
+      self.value = None
+      self.expires_at = 0
+
+  def invalidate_on_change(self, model):
+    '''
+    Invalidates the value whenever a row of model is inserted, updated or
+    deleted through the ORM in this process. Other worker processes, and
+    writes made through Core statements or outside the app, are not seen:
+    their changes show once ttl has passed, or after an explicit invalidate()
+    '''
+    with watchers_lock:
+      watchers.setdefault(model, weakref.WeakSet()).add(self)
+      for name in CHANGE_EVENTS:
+        if not event.contains(model, name, invalidate_watchers):
+          event.listen(model, name, invalidate_watchers)
+
+
+def invalidate_watchers(mapper, connection, target):
+  with watchers_lock:
+    values = list(watchers.get(mapper.class_, ()))
+  for value in values:
+    value.invalidate()
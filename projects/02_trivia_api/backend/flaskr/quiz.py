@@ -0,0 +1,235 @@
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from models import db, Question
+
+'''
+quiz_category_id(quiz_category, category_ids)
+    returns the database id of the category chosen for a quiz, or None when
+    playing all categories. The frontend sends categories by their zero-based
+    position in the /categories list, and "All" as the number 0.
+'''
+def quiz_category_id(quiz_category, category_ids):
+  if not quiz_category:
+    return None
+  position = quiz_category.get('id', 0)
+  if position is None or (position == 0 and not isinstance(position, str)):
+    return None
+  return category_at(category_ids, position)
+
+'''
+category_at(category_ids, position)
+    returns the id at position in category_ids, the ids of the /categories
+    list in order, which need not run from 1 without gaps. Raises IndexError
+    when there is no category at position
+'''
+def category_at(category_ids, position):
+  position = int(position)
+  if not 0 <= position < len(category_ids):
+    raise IndexError('No category at position {}'.format(position))
+  return category_ids[position]
+
+'''
+QuestionSampler
+    picks random questions without sorting or loading the questions table.
+    The ids of each category's questions are kept in compact arrays, loaded
+    with one indexed query per category and reloaded after ttl seconds, so
+    that each pick is a random index into an array and a primary key lookup.
+    Questions created or deleted through the API are added to or removed
+    from the arrays of their category and of all categories, rather than
+    having the arrays reloaded.
+'''
+class QuestionSampler(object):
+  # Random draws to try before falling back to filtering the whole array
+  MAX_DRAWS = 32
+
+  def __init__(self, ttl=300):
+    self.ttl = ttl
+    self.ids = {}
+    self.lock = threading.Lock()
+
+  def question_ids(self, category_id=None):
+    with self.lock:
+      ids, loaded_at = self.ids.get(category_id, (None, 0))
+      if ids is None or time.monotonic() - loaded_at > self.ttl:
+        # A Core select skips building ORM rows for what can be a million ids
+        query = select([Question.id])
+        if category_id is not None:
+          query = query.where(Question.category == category_id)
+        ids = array('l', (question_id for (question_id,) in db.session.execute(query)))
+        self.ids[category_id] = (ids, time.monotonic())
+      return ids
+
+  def replace_ids(self, category_id, change):
+    # Arrays are replaced rather than modified, since quiz decks share them.
+    # Only the arrays already loaded are changed, keeping their load time
+    with self.lock:
+      for key in (None, category_id):
+        if key in self.ids:
+          ids, loaded_at = self.ids[key]
+          self.ids[key] = (change(ids), loaded_at)
+
+  def add(self, question_id, category_id):
+    self.replace_ids(category_id, lambda ids: ids + array('l', [question_id]))
+
+  def remove(self, question_id, category_id):
+    def without(ids):
+      try:
+        position = ids.index(question_id)
+      except ValueError:
+        return ids
+      return ids[:position] + ids[position + 1:]
+    self.replace_ids(category_id, without)
+
+  def invalidate(self, category_ids=None):
+    '''
+    Drops the arrays of category_ids, and of all categories, to be reloaded
+    when next used, or every array when category_ids is None
+    '''
+    with self.lock:
+      if category_ids is None:
+        self.ids.clear()
+        return
+      for key in set(category_ids) | set([None]):
+        self.ids.pop(key, None)
+
+  def pick_id(self, ids, excluded_ids):
+    # Random draws succeed quickly while most questions remain
+    for _ in range(min(len(ids), self.MAX_DRAWS)):
+      question_id = ids[random.randrange(len(ids))]
+      if question_id not in excluded_ids:
+        return question_id
+    remaining = [question_id for question_id in ids if question_id not in excluded_ids]
+    return random.choice(remaining) if remaining else None
+
+  def sample(self, category_id=None, excluded_ids=()):
+    '''
+    Returns a random Question in category_id, or in any category when it is
+    None, whose id is not in excluded_ids, or None when none remain
+    '''
+    excluded_ids = set(excluded_ids)
+    for attempt in range(self.MAX_DRAWS):
+      question_id = self.pick_id(self.question_ids(category_id), excluded_ids)
+      if question_id is None:
+        return None
+      question = Question.query.get(question_id)
+      if question is not None:
+        return question
+      # Deleted since the ids were loaded, possibly by another worker
+      self.remove(question_id, category_id)
+      excluded_ids.add(question_id)
+    return None
+
+'''
+QuizDeck
+    a shuffled deck of question ids for one quiz, dealt one card at a time.
+    The deck is a lazy Fisher-Yates shuffle over a shared id array: dealing
+    swaps a random remaining card into the next position, recording only the
+    positions that moved, so a deck costs nothing to create and each deal is
+    constant time however many questions there are.
+'''
+class QuizDeck(object):
+  def __init__(self, ids):
+    self.ids = ids
+    self.dealt = 0
+    self.swaps = {}
+
+  def __len__(self):
+    return len(self.ids) - self.dealt
+
+  def deal(self):
+    if self.dealt >= len(self.ids):
+      return None
+    i = self.dealt
+    j = random.randrange(i, len(self.ids))
+    card = self.swaps.get(j, self.ids[j])
+    if j != i:
+      self.swaps[j] = self.swaps.get(i, self.ids[i])
+    self.swaps.pop(i, None)
+    self.dealt += 1
+    return card
+
+'''
+QuizSessions
+    quizzes in progress, each holding the category played and its deck, by
+    an unguessable session id. Sessions expire ttl seconds after their last
+    turn, and the least recently played are dropped beyond max_sessions.
+
+    Sessions live in the memory of the process that started them, so a turn
+    handled by any other worker process finds no session. Serve quiz
+    sessions from a single worker, or route each client to the same worker
+    with sticky sessions.
+'''
+class QuizSessions(object):
+  def __init__(self, sampler, ttl=1800, max_sessions=10000):
+    self.sampler = sampler
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self.sessions = OrderedDict()
+    self.lock = threading.Lock()
+
+  def start(self, category_id=None):
+    # Decks share the sampler's id array, which is replaced rather than
+    # modified when it is reloaded
+    deck = QuizDeck(self.sampler.question_ids(category_id))
+    session_id = secrets.token_urlsafe(16)
+    with self.lock:
+      self.expire()
+      self.sessions[session_id] = (deck, time.monotonic() + self.ttl)
+      while len(self.sessions) > self.max_sessions:
+        self.sessions.popitem(last=False)
+    return session_id
+
+  def deck(self, session_id):
+    '''
+    Returns the deck of session_id, extending its lifetime, or None when
+    there is no such session or it has expired
+    '''
+    with self.lock:
+      entry = self.sessions.get(session_id)
+      if entry is None or entry[1] <= time.monotonic():
+        self.sessions.pop(session_id, None)
+        return None
+      self.sessions[session_id] = (entry[0], time.monotonic() + self.ttl)
+      self.sessions.move_to_end(session_id)
+      return entry[0]
+
+  def next_question(self, session_id):
+    '''
+    Deals the next question of session_id. Raises KeyError for an unknown
+    or expired session, and returns None once the deck is empty
+    '''
+    deck = self.deck(session_id)
+    if deck is None:
+      raise KeyError(session_id)
+    while True:
+      with self.lock:
+        question_id = deck.deal()
+      if question_id is None:
+        return None
+      question = Question.query.get(question_id)
+      # Skip questions deleted since the quiz started
+      if question is not None:
+        return question
+
+  def end(self, session_id):
+    with self.lock:
+      self.sessions.pop(session_id, None)
+
+  def expire(self):
+    # Sessions are kept in order of last use, so expired ones come first
+    now = time.monotonic()
+    while self.sessions:
+      session_id, (deck, expires_at) = next(iter(self.sessions.items()))
+      if expires_at > now:
+        break
+      del self.sessions[session_id]
+
+  def __len__(self):
+    return len(self.sessions)
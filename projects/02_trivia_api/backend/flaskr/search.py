@@ -0,0 +1,94 @@
+'''
+Question search.
+
+Matches a term against the text of each question and its answer. On
+PostgreSQL whole words are matched through a GIN index over the documents'
+tsvector and ranked with ts_rank, and a pg_trgm GIN index over the same text
+serves the substring fallback, so that partial words such as "tit" still
+find "title". Other databases scan with ILIKE and rank matches in the
+question before matches in the answer.
+'''
+import re
+
+import sqlalchemy
+from sqlalchemy import DDL, Integer, case, cast, event, func, literal_column, or_
+
+from models import db, Question
+from .serialize import QUESTION_COLUMNS
+
+SEARCH_CONFIG = 'english'
+
+# Spelled out as SQL so that queries repeat the indexed expressions exactly
+SEARCH_DOCUMENT = "coalesce(questions.question, '') || ' ' || coalesce(questions.answer, '')"
+SEARCH_VECTOR = "to_tsvector('{}', {})".format(SEARCH_CONFIG, SEARCH_DOCUMENT)
+
+event.listen(
+  db.Model.metadata,
+  'before_create',
+  DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql')
+)
+event.listen(
+  db.Model.metadata,
+  'after_create',
+  DDL(
+    'CREATE INDEX IF NOT EXISTS ix_questions_search_tsv ON questions USING gin '
+    '({})'.format(SEARCH_VECTOR.replace('questions.', ''))
+  ).execute_if(dialect='postgresql')
+)
+event.listen(
+  db.Model.metadata,
+  'after_create',
+  DDL(
+    'CREATE INDEX IF NOT EXISTS ix_questions_search_trgm ON questions USING gin '
+    '(({}) gin_trgm_ops)'.format(SEARCH_DOCUMENT.replace('questions.', ''))
+  ).execute_if(dialect='postgresql')
+)
+
+# case() takes its whens as positional arguments from SQLAlchemy 1.4, the only
+# form 2.0 accepts, and as a list in the 1.3 release requirements.txt pins
+CASE_WHENS_POSITIONAL = tuple(int(part) for part in sqlalchemy.__version__.split('.')[:2]) >= (1, 4)
+
+def case_when(condition, value, else_):
+  if CASE_WHENS_POSITIONAL:
+    return case((condition, value), else_=else_)
+  return case([(condition, value)], else_=else_)
+
+# Escapes LIKE wildcards so that the term is matched literally
+def escape_like(term):
+  return re.sub(r'([\\%_])', r'\\\1', term)
+
+'''
+search_questions(search_term, page, per_page, category=None, difficulty=None)
+    returns the (id, question, answer, category, difficulty) rows of the page
+    of questions matching search_term, best match first, optionally only
+    those of a category id or difficulty, and the number of matches on every
+    page
+'''
+def search_questions(search_term, page, per_page, category=None, difficulty=None):
+  term = search_term.strip()
+  pattern = '%' + escape_like(term) + '%'
+  if db.session.get_bind().dialect.name == 'postgresql':
+    document = literal_column('({})'.format(SEARCH_DOCUMENT))
+    vector = literal_column(SEARCH_VECTOR)
+    query = func.plainto_tsquery(SEARCH_CONFIG, term)
+    match = or_(vector.op('@@')(query), document.ilike(pattern, escape='\\'))
+    rank = func.ts_rank(vector, query)
+  else:
+    match = or_(Question.question.ilike(pattern, escape='\\'), Question.answer.ilike(pattern, escape='\\'))
+    rank = cast(case_when(Question.question.ilike(pattern, escape='\\'), 1, else_=0), Integer)
+  questions = db.session.query(
+    *QUESTION_COLUMNS,
+    # The number of matches comes back with every row of the page
+    func.count().over().label('total')
+  ).filter(match)
+  if category is not None:
+    questions = questions.filter(Question.category == category)
+  if difficulty is not None:
+    questions = questions.filter(Question.difficulty == difficulty)
+  page_query = questions.order_by(rank.desc(), Question.id).limit(per_page).offset((page - 1) * per_page)
+  rows = db.session.execute(page_query.statement).fetchall()
+  if rows:
+    total = rows[0].total
+  else:
+    total = questions.with_entities(func.count(Question.id)).scalar() if page > 1 else 0
+  return [row[:-1] for row in rows], total
@@ -0,0 +1,89 @@
+'''
+Serialization of questions for the API's responses.
+
+Listings read the columns of a question as plain tuples through a Core
+statement, rather than loading Question objects, and pair them with
+QUESTION_FIELDS only as they are encoded. Bodies are encoded by the module
+the JSON_MODULE setting names: json by default, or a faster drop-in such as
+orjson or ujson when it is installed. Arrays longer than CHUNKED_THRESHOLD are
+encoded a chunk at a time, as the response is sent, instead of in a single
+piece. The rows themselves are all fetched first: a page holds at most
+MAX_QUESTIONS_PER_PAGE of them, its metadata needs the first and last, and
+reading them from an open cursor would hold a pooled connection for as long
+as the client takes to download the body.
+'''
+import importlib
+import json
+from itertools import islice
+
+from models import db, Question
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+# Arrays longer than this are encoded in chunks of this many items
+CHUNKED_THRESHOLD = 200
+CHUNK_SIZE = 200
+
+
+def fetch_question_rows(query):
+  '''
+  Returns the (id, question, answer, category, difficulty) rows of a
+  Question query, fetched in full, without building ORM objects for them
+  '''
+  return db.session.execute(query.with_entities(*QUESTION_COLUMNS).statement).fetchall()
+
+
+def question_dicts(rows):
+  return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def compact_dumps(value):
+  return json.dumps(value, separators=(',', ':'))
+
+
+'''
+JSONSerializer(module='json')
+    encodes response bodies with the dumps function of module, a module name
+    or an object with a dumps method. Encoders returning str, such as json
+    and ujson, and those returning bytes, such as orjson, both work.
+'''
+class JSONSerializer(object):
+  def __init__(self, module='json'):
+    if isinstance(module, str):
+      module = importlib.import_module(module)
+    self.dumps = compact_dumps if module is json else module.dumps
+
+  def encode(self, value):
+    encoded = self.dumps(value)
+    return encoded.encode('utf-8') if isinstance(encoded, str) else encoded
+
+  def encode_chunks(self, payload, key, items, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the JSON of payload with the array items under key, encoding the
+    array chunk_size items at a time
+    '''
+    head = self.encode(payload)
+    yield head[:-1] + (b',' if len(head) > 2 else b'') + self.encode(key) + b':['
+    items = iter(items)
+    separator = b''
+    while True:
+      chunk = list(islice(items, chunk_size))
+      if not chunk:
+        break
+      yield separator + self.encode(chunk)[1:-1]
+      separator = b','
+    yield b']}'
+
+  def response(self, app, payload, status=200):
+    return app.response_class(self.encode(payload), status=status, mimetype='application/json')
+
+  def questions_response(self, app, payload, rows):
+    '''
+    Returns a response of payload with the question rows as its questions,
+    encoded in chunks when there are more than CHUNKED_THRESHOLD of them
+    '''
+    if len(rows) <= CHUNKED_THRESHOLD:
+      return self.response(app, dict(payload, questions=question_dicts(rows)))
+    questions = (dict(zip(QUESTION_FIELDS, row)) for row in rows)
+    return app.response_class(self.encode_chunks(payload, 'questions', questions), mimetype='application/json')
@@ -1,10 +1,21 @@
+import gc
 import os
 import unittest
 import json
+import tempfile
+import time
+import weakref
 from flask_sqlalchemy import SQLAlchemy
 
+from sqlalchemy import create_engine, event
+
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.bulk import read_dump_tables
+from flaskr.cache import CachedValue, invalidate_watchers
+from flaskr.quiz import QuestionSampler, QuizSessions
+from flaskr.serialize import JSONSerializer
+from models import db, setup_db, Question, Category
+from pool import engine_options, pool_health
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,29 +23,499 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+        self.database_path = os.environ.get(
+            'TRIVIA_TEST_DATABASE_URL',
+            "postgres://{}/{}".format('localhost:5432', self.database_name)
+        )
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        self.client = self.app.test_client
 
         # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.db = db
+        # create all tables
+        self.db.create_all()
+        self.category_ids = []
+
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        self.db.session.rollback()
+        # Remove the rows added by the test, including through the API
+        Question.query.filter(Question.category.in_(self.category_ids)).delete(synchronize_session=False)
+        Category.query.filter(Category.id.in_(self.category_ids)).delete(synchronize_session=False)
+        self.db.session.commit()
+        self.db.session.remove()
+        self.app_context.pop()
+
+    def add_category(self, type):
+        category = Category(type)
+        self.db.session.add(category)
+        self.db.session.commit()
+        self.category_ids.append(category.id)
+        return category
+
+    def add_questions(self, category, count):
+        questions = [
+            Question('Question {}?'.format(i), 'Answer {}'.format(i), category.id, 1)
+            for i in range(count)
+        ]
+        self.db.session.add_all(questions)
+        self.db.session.commit()
+        return questions
+
+    def play(self, quiz_category, previous_questions):
+        return self.client().post('/quizzes/1/play', json={
+            'quiz_category': quiz_category,
+            'previous_questions': previous_questions
+        })
+
+    def category_position(self, category):
+        # The frontend sends the zero-based position of the category in /categories
+        return str([row.id for row in Category.query.order_by(Category.id)].index(category.id))
+
+    def play_session(self, quiz_session):
+        return self.client().post('/quizzes/1/play', json={'quiz_session': quiz_session})
 
     """
     TODO
     Write at least one test for each test for successful operation and for expected errors.
     """
 
+    def test_play_quiz_in_category(self):
+        category = self.add_category('Quiz category')
+        questions = self.add_questions(category, 5)
+        ids = set(question.id for question in questions)
+        quiz_category = {'type': category.type, 'id': self.category_position(category)}
+
+        seen = []
+        for _ in range(5):
+            res = self.play(quiz_category, seen)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['question']['category'], category.id)
+            self.assertIn(data['question']['id'], ids)
+            self.assertNotIn(data['question']['id'], seen)
+            seen.append(data['question']['id'])
+
+        res = self.play(quiz_category, seen)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['question'])
+
+    def test_play_quiz_in_all_categories(self):
+        category = self.add_category('Quiz category')
+        questions = self.add_questions(category, 2)
+        excluded = [question.id for question in Question.query.filter(Question.id != questions[0].id)]
+
+        res = self.play({'type': 'click', 'id': 0}, excluded)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], questions[0].id)
+
+    def test_play_quiz_sees_new_questions(self):
+        category = self.add_category('Quiz category')
+        category_id = category.id
+        quiz_category = {'type': category.type, 'id': self.category_position(category)}
+
+        res = self.play(quiz_category, [])
+        self.assertIsNone(json.loads(res.data)['question'])
+
+        res = self.client().post('/questions/create', json={
+            'question': 'New question?',
+            'answer': 'New answer',
+            'difficulty': 1,
+            'category': self.category_position(category)
+        })
+        self.assertEqual(res.status_code, 200)
+        res = self.play(quiz_category, [])
+        question = json.loads(res.data)['question']
+        self.assertEqual(question['question'], 'New question?')
+        self.assertEqual(question['category'], category_id)
+
+    def test_play_quiz_bad_request(self):
+        res = self.play({'type': 'click', 'id': 'Science'}, [])
+        self.assertEqual(res.status_code, 400)
+
+    def test_play_quiz_after_deleted_category(self):
+        removed = self.add_category('Removed category')
+        category = self.add_category('Quiz category')
+        question = self.add_questions(category, 1)[0]
+        self.db.session.delete(removed)
+        self.db.session.commit()
+
+        # Positions skip the gap the deleted category leaves in the ids
+        res = self.play({'type': category.type, 'id': self.category_position(category)}, [])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['question']['id'], question.id)
+
+    def test_play_quiz_unknown_category(self):
+        position = str(Category.query.count())
+        res = self.play({'type': 'Unknown', 'id': position}, [])
+        self.assertEqual(res.status_code, 422)
+        res = self.client().post('/quizzes', json={'quiz_category': {'type': 'Unknown', 'id': position}})
+        self.assertEqual(res.status_code, 422)
+
+    def test_play_quiz_session(self):
+        category = self.add_category('Quiz category')
+        ids = set(question.id for question in self.add_questions(category, 5))
+
+        res = self.client().post('/quizzes', json={
+            'quiz_category': {'type': category.type, 'id': self.category_position(category)}
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        session = data['quiz_session']
+        dealt = [data['question']['id']]
+        for _ in range(4):
+            res = self.play_session(session)
+            self.assertEqual(res.status_code, 200)
+            dealt.append(json.loads(res.data)['question']['id'])
+        self.assertEqual(sorted(dealt), sorted(ids))
+
+        res = self.play_session(session)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(json.loads(res.data)['question'])
+
+    def test_play_quiz_unknown_session(self):
+        res = self.play_session('not-a-session')
+        self.assertEqual(res.status_code, 404)
+
+    def test_quiz_session_expires(self):
+        category = self.add_category('Quiz category')
+        self.add_questions(category, 2)
+        sessions = QuizSessions(QuestionSampler(), ttl=0.05)
+        session = sessions.start(category.id)
+        self.assertIsNotNone(sessions.next_question(session))
+
+        time.sleep(0.1)
+        with self.assertRaises(KeyError):
+            sessions.next_question(session)
+        self.assertEqual(len(sessions), 0)
+        with self.assertRaises(KeyError):
+            sessions.next_question('not-a-session')
+
+    def test_sampler_updates_only_the_changed_category(self):
+        category = self.add_category('Quiz category')
+        other = self.add_category('Other category')
+        question = self.add_questions(category, 2)[0]
+        other_question = self.add_questions(other, 1)[0]
+        sampler = QuestionSampler()
+        dealt = sampler.question_ids(category.id)
+        other_ids = sampler.question_ids(other.id)
+
+        sampler.add(1000000, category.id)
+        sampler.remove(question.id, category.id)
+        self.assertIs(sampler.question_ids(other.id), other_ids)
+        self.assertEqual(set(sampler.question_ids(category.id)), set(dealt) - {question.id} | {1000000})
+        # Arrays already dealt from are left as they were
+        self.assertIn(question.id, dealt)
+
+        sampler.invalidate([category.id])
+        self.assertIs(sampler.question_ids(other.id), other_ids)
+        self.assertEqual(list(sampler.question_ids(other.id)), [other_question.id])
+
+    def test_get_questions(self):
+        category = self.add_category('Paged category')
+        self.add_questions(category, 12)
+
+        res = self.client().get('/questions?page=1')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 10)
+        self.assertEqual(data['total_questions'], Question.query.count())
+        self.assertIn('Paged category', data['categories'])
+        self.assertIsNotNone(data['next_cursor'])
+
+        last_page = (data['total_questions'] + 9) // 10
+        res = self.client().get('/questions?page={}'.format(last_page + 1))
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'], [])
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+    def test_get_questions_after_cursor(self):
+        category = self.add_category('Paged category')
+        self.add_questions(category, 25)
+
+        ids = []
+        cursor = 0
+        while cursor is not None:
+            res = self.client().get('/questions?after={}'.format(cursor))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            ids.extend(question['id'] for question in data['questions'])
+            cursor = data['next_cursor']
+        self.assertEqual(ids, [question.id for question in Question.query.order_by(Question.id)])
+
+    def test_get_questions_sees_new_categories(self):
+        self.client().get('/questions')
+        category = self.add_category('New category')
+
+        res = self.client().get('/questions')
+        data = json.loads(res.data)
+        self.assertIn(category.type, data['categories'])
+
+    def test_get_questions_bad_page(self):
+        res = self.client().get('/questions?page=first')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_categories(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories'], [category.type for category in Category.query.order_by(Category.id)])
+        self.assertIsNotNone(res.headers.get('ETag'))
+        self.assertIn('max-age', res.headers['Cache-Control'])
+
+    def test_get_categories_max_age(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path, 'CATEGORIES_MAX_AGE': 30})
+        with app.app_context():
+            self.db.create_all()
+            res = app.test_client().get('/categories')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.cache_control.max_age, 30)
+
+    def test_get_categories_not_modified(self):
+        etag = self.client().get('/categories').headers['ETag']
+
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        self.add_category('New category')
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertIn('New category', json.loads(res.data)['categories'])
+
+    def test_cached_values_share_change_listeners(self):
+        values = [CachedValue(lambda: Category.query.count()) for _ in range(2)]
+        for value in values:
+            value.invalidate_on_change(Category)
+            value.get()
+        self.add_category('New category')
+        self.assertEqual([value.expires_at for value in values], [0, 0])
+
+        # The shared listener does not keep values no longer in use alive
+        references = [weakref.ref(value) for value in values]
+        del values, value
+        gc.collect()
+        self.assertEqual([reference() for reference in references], [None, None])
+        self.assertTrue(event.contains(Category, 'after_insert', invalidate_watchers))
+
+    def search(self, **body):
+        return self.client().post('/questions/search', json=body)
+
+    def test_search_questions(self):
+        category = self.add_category('Search category')
+        questions = [
+            Question('Which zebrafish answer comes second?', 'Second', category.id, 2),
+            Question('What is the title?', 'The zebrafish', category.id, 1),
+            Question('Which zebrafish answer comes first?', 'First', category.id, 1),
+        ]
+        self.db.session.add_all(questions)
+        self.db.session.commit()
+
+        res = self.search(searchTerm='zebrafish')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 3)
+        self.assertEqual(len(data['questions']), 3)
+
+        res = self.search(searchTerm='ZEBRA', category=category.id, difficulty=1)
+        data = json.loads(res.data)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual(data['current_category'], category.id)
+        self.assertEqual(set(question['difficulty'] for question in data['questions']), {1})
+
+    def test_search_questions_pages(self):
+        category = self.add_category('Search category')
+        self.add_questions(category, 15)
+
+        ids = []
+        for page in (1, 2, 3):
+            res = self.search(searchTerm='question', category=category.id, page=page)
+            data = json.loads(res.data)
+            self.assertEqual(data['total_questions'], 15)
+            ids.extend(question['id'] for question in data['questions'])
+        self.assertEqual(len(ids), 15)
+        self.assertEqual(len(set(ids)), 15)
+
+    def test_search_questions_escapes_wildcards(self):
+        category = self.add_category('Search category')
+        self.add_questions(category, 2)
+
+        res = self.search(searchTerm='%', category=category.id)
+        data = json.loads(res.data)
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_search_questions_bad_request(self):
+        res = self.search(term='missing searchTerm')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_category_questions(self):
+        category = self.add_category('Listed category')
+        other = self.add_category('Other category')
+        questions = self.add_questions(category, 12)
+        self.add_questions(other, 3)
+
+        res = self.client().get('/categories/{}/questions'.format(category.id))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 12)
+        self.assertEqual(data['current_category'], category.id)
+        self.assertEqual([question['id'] for question in data['questions']], [question.id for question in questions[:10]])
+
+        res = self.client().get('/categories/{}/questions?after={}'.format(category.id, data['next_cursor']))
+        data = json.loads(res.data)
+        self.assertEqual([question['id'] for question in data['questions']], [question.id for question in questions[10:]])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_get_category_questions_counts_new_questions(self):
+        category = self.add_category('Listed category')
+        self.add_questions(category, 2)
+        self.client().get('/categories/{}/questions'.format(category.id))
+
+        self.add_questions(category, 1)
+        res = self.client().get('/categories/{}/questions'.format(category.id))
+        self.assertEqual(json.loads(res.data)['total_questions'], 3)
+
+    def test_get_category_questions_not_found(self):
+        res = self.client().get('/categories/100000/questions')
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_category_questions_large_page(self):
+        category = self.add_category('Listed category')
+        questions = self.add_questions(category, 250)
+
+        res = self.client().get('/categories/{}/questions?per_page=250'.format(category.id))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        # Encoded in chunks as it is sent, so the length is not known up front
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(data['total_questions'], 250)
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(data['questions'][0], questions[0].format())
+        self.assertEqual([question['id'] for question in data['questions']], [question.id for question in questions])
+
+    def test_get_questions_bad_page_size(self):
+        for per_page in ('0', '1001', 'all'):
+            res = self.client().get('/questions?per_page={}'.format(per_page))
+            self.assertEqual(res.status_code, 400)
+
+    def test_json_serializer(self):
+        class BytesEncoder(object):
+            @staticmethod
+            def dumps(value):
+                return json.dumps(value).encode('utf-8')
+
+        rows = [(i, 'Question?', 'Answer', 1, 2) for i in range(5)]
+        for serializer in (JSONSerializer(), JSONSerializer(BytesEncoder)):
+            body = b''.join(serializer.encode_chunks({'total_questions': 5}, 'questions', iter(rows), chunk_size=2))
+            self.assertEqual(json.loads(body), {'total_questions': 5, 'questions': [list(row) for row in rows]})
+            self.assertEqual(json.loads(b''.join(serializer.encode_chunks({}, 'questions', iter([])))), {'questions': []})
+
+    def test_create_question_is_validated(self):
+        category = self.add_category('New category')
+        question = {'question': 'New question?', 'answer': 'New answer', 'difficulty': 1}
+        res = self.client().post('/questions/create', json=dict(question, category=str(Category.query.count())))
+        self.assertEqual(res.status_code, 422)
+        for invalid in ({'difficulty': 9}, {'question': ' '}, {'category': 'Science'}):
+            body = dict(question, category=self.category_position(category))
+            body.update(invalid)
+            res = self.client().post('/questions/create', json=body)
+            self.assertEqual(res.status_code, 400, invalid)
+        self.assertEqual(Question.query.filter(Question.category == category.id).count(), 0)
+
+    def test_bulk_create_questions(self):
+        category = self.add_category('Bulk category')
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+        res = self.client().post('/questions/bulk', json=[
+            {'question': 'First?', 'answer': 'One', 'category': category.id, 'difficulty': 1},
+            {'question': '', 'answer': 'Blank', 'category': category.id, 'difficulty': 1},
+            {'question': 'Third?', 'answer': 'Three', 'category': 100000, 'difficulty': 1},
+            {'question': 'Fourth?', 'answer': 'Four', 'category': str(category.id), 'difficulty': '5'},
+        ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2, 3])
+        self.assertEqual(
+            sorted(question.question for question in Question.query.filter(Question.category == category.id)),
+            ['First?', 'Fourth?']
+        )
+        res = self.client().get('/categories/{}/questions'.format(category.id))
+        self.assertEqual(json.loads(res.data)['total_questions'], 2)
+        res = self.client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total + 2)
+
+    def test_bulk_create_questions_csv_and_json_lines(self):
+        category = self.add_category('Bulk category')
+        csv_body = 'question,answer,category,difficulty\nFrom CSV?,Yes,{0},2\nBad,row,{0},9\n'.format(category.id)
+        res = self.client().post('/questions/bulk', data=csv_body, content_type='text/csv')
+        data = json.loads(res.data)
+        self.assertEqual((data['imported'], data['failed']), (1, 1))
+        self.assertEqual(data['errors'][0]['row'], 3)
+
+        jsonl_body = '{{"question": "From JSON Lines?", "answer": "Yes", "category": {}, "difficulty": 2}}\nnot json\n'.format(category.id)
+        res = self.client().post('/questions/bulk', data=jsonl_body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+        self.assertEqual((data['imported'], data['failed']), (1, 1))
+        self.assertEqual(Question.query.filter(Question.category == category.id).count(), 2)
+
+    def test_bulk_create_questions_bad_request(self):
+        res = self.client().post('/questions/bulk', data='questions', content_type='text/plain')
+        self.assertEqual(res.status_code, 400)
+
+    def test_import_command(self):
+        category_id = self.add_category('Bulk category').id
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'questions.jsonl')
+            with open(path, 'w') as file:
+                for i in range(25):
+                    file.write(json.dumps({'question': 'Imported {}?'.format(i), 'answer': 'Yes', 'category': category_id, 'difficulty': 3}) + '\n')
+            result = self.app.test_cli_runner().invoke(args=['questions', 'import', path, '--batch-size', '10'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Imported 25 questions, rejected 0', result.output)
+        self.assertEqual(Question.query.filter(Question.category == category_id).count(), 25)
+
+    def test_read_fixture(self):
+        with open(os.path.join(os.path.dirname(__file__), 'trivia.psql')) as file:
+            tables = dict((name, (columns, rows)) for name, columns, rows in read_dump_tables(file))
+        columns, rows = tables['categories']
+        self.assertEqual(columns, ['id', 'type'])
+        self.assertEqual(rows[0], ['1', 'Science'])
+        columns, rows = tables['questions']
+        self.assertEqual(columns, ['id', 'question', 'answer', 'difficulty', 'category'])
+        self.assertTrue(all(len(row) == 5 for row in rows))
+
+    def test_healthz(self):
+        res = self.client().get('/healthz')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['status'], 'ok')
+        self.assertEqual(data['database'], 'ok')
+
+    def test_pool_health(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'pool.db')
+            options = engine_options({'DB_POOL_SIZE': 1, 'DB_MAX_OVERFLOW': 0, 'DB_POOL_TIMEOUT': 0.01}, 'postgresql://localhost/trivia')
+            del options['pool_pre_ping']
+            engine = create_engine(url, **options)
+            connection = engine.connect()
+            health = pool_health(engine)
+            connection.close()
+            engine.dispose()
+        self.assertEqual(health['database'], 'unavailable')
+        self.assertEqual(health['checked_out'], 1)
+        self.assertEqual(health['saturation'], 1.0)
+        self.assertEqual(health['checkout_timeouts'], 1)
+        self.assertEqual(health['checkouts'], 2)
+        self.assertEqual(health['error'], 'TimeoutError')
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
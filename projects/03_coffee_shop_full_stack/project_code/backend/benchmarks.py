@@ -0,0 +1,98 @@
+'''
+Benchmarks for the coffee shop API.
+
+Signs tokens with a throwaway RSA key, served to the app as a local key set,
+and reports the requests per second of GET /drinks-detail with and without
+the verified-token cache. Uses an in-memory SQLite database unless
+BENCHMARK_DATABASE_URL points elsewhere.
+
+    python benchmarks.py --requests 2000 --tokens 1 10 1000
+'''
+import argparse
+import os
+import time
+
+# The benchmark drops every table, so it never uses the database DATABASE_URL names
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite://')
+
+import rsa
+from jose import jwk, jwt
+
+from src import api
+from src.auth import auth
+from src.auth.jwks import JWKSKeyStore
+from src.auth.token_cache import VerifiedTokenCache
+from src.database.models import db, Drink
+
+RECIPE = [{'name': 'espresso', 'color': 'brown', 'parts': 1}, {'name': 'milk', 'color': 'white', 'parts': 2}]
+
+
+def use_signing_key(kid='benchmark-key'):
+    '''
+    Makes the app verify tokens against a new key, and returns the private
+    key in PEM form
+    '''
+    public_key, private_key = rsa.newkeys(2048)
+    public_jwk = jwk.construct(public_key.save_pkcs1().decode('utf-8'), auth.ALGORITHMS[0]).to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    auth.jwks_store = JWKSKeyStore(auth.JWKS_URL, fetch=lambda url, timeout: {'keys': [public_jwk]})
+    return private_key.save_pkcs1().decode('utf-8')
+
+
+def sign_tokens(private_key, count, kid='benchmark-key'):
+    tokens = []
+    for i in range(count):
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'sub': 'auth0|barista-{}'.format(i),
+            'exp': int(time.time()) + 3600,
+            'permissions': ['get:drinks-detail']
+        }
+        tokens.append(jwt.encode(claims, private_key, algorithm=auth.ALGORITHMS[0], headers={'kid': kid}))
+    return tokens
+
+
+def seed_drinks(count):
+    for i in range(count):
+        db.session.add(Drink(title='Drink {}'.format(i), recipe=RECIPE))
+    db.session.commit()
+
+
+def requests_per_second(client, tokens, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        res = client.get('/drinks-detail', headers={'Authorization': 'Bearer ' + tokens[i % len(tokens)]})
+        assert res.status_code == 200, res.status_code
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark token verification on GET /drinks-detail.')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--tokens', type=int, nargs='+', default=[1, 10, 1000], help='Numbers of distinct tokens sent in turn.')
+    parser.add_argument('--drinks', type=int, default=10)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    private_key = use_signing_key()
+    client = api.app.test_client()
+    with api.app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_drinks(args.drinks)
+    print('{:>8} {:<10} {:>12} {:>10}'.format('tokens', 'cache', 'requests/s', 'hit rate'))
+    for count in args.tokens:
+        tokens = sign_tokens(private_key, count)
+        for label, cache_size in (('off', 0), ('on', args.cache_size)):
+            auth.token_cache = VerifiedTokenCache(cache_size)
+            rate = requests_per_second(client, tokens, args.requests)
+            lookups = auth.token_cache.hits + auth.token_cache.misses
+            print('{:>8} {:<10} {:>12.0f} {:>10}'.format(
+                count, label, rate,
+                '{:.0%}'.format(auth.token_cache.hits / lookups) if lookups else ''
+            ))
+
+
+if __name__ == '__main__':
+    main()
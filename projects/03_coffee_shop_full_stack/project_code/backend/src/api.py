@@ -11,6 +11,7 @@ from flask import (
     )
 from sqlalchemy import exc
 import json
+import click
 # from flask_cors import CORS
 import sys
 
@@ -20,42 +21,85 @@ sys.path.append('/Users/Jac/Documents/udacity/FSND/projects/01_fyyur/env/bin')
 sys.path.append('/Library/Frameworks/Python.framework/Versions/3.8/lib/python3.8/site-packages')
 sys.path.append('/Users/Jac/Library/Python/3.8/lib/python/site-packages')
 
-from .database.models import db, db_drop_and_create_all, setup_db, Drink
+from .database.models import db, db_drop_and_create_all, db_upgrade_recipes, setup_db, Drink
+from .database.snapshot import SharedSnapshot, database_fingerprint, snapshot_directory
+from .database.pool import pool_health
 from .auth.auth import AuthError, requires_auth
 
 app = Flask(__name__)
+# Database pool settings such as DB_POOL_SIZE come from the file COFFEE_SHOP_SETTINGS names
+app.config.from_envvar('COFFEE_SHOP_SETTINGS', silent=True)
 setup_db(app)
 # CORS(app)
 
 '''
-!! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-!! NOTE THIS MUST BE UNCOMMENTED ON FIRST RUN
+The menu GET /drinks serves, serialized once for each version and shared
+between worker processes through the files under MENU_SNAPSHOT_DIR
 '''
-db_drop_and_create_all()
+def build_menu():
+    return ('{"success": true, "drinks": ' + Drink.short_listing() + '}').encode('utf-8')
+
+menu_snapshot = SharedSnapshot(
+    'menu',
+    build_menu,
+    app.config.get('MENU_SNAPSHOT_DIR') or snapshot_directory(app.config['SQLALCHEMY_DATABASE_URI']),
+    # Catches drink changes made outside this app, which bump no version
+    database_fingerprint(app.config['SQLALCHEMY_DATABASE_URI'], app.config.get('MENU_SNAPSHOT_MAX_AGE', 60))
+)
+# Committed drink changes, from the routes below or elsewhere, bump its version
+menu_snapshot.bump_on_commit(Drink)
+
+'''
+Create the tables once, before the first run, with:
+    flask create-tables
+!! NOTE --drop WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
+'''
+@app.cli.command('create-tables')
+@click.option('--drop', is_flag=True, help='Drop all tables and records first.')
+def create_tables_command(drop):
+    if drop:
+        db_drop_and_create_all()
+    else:
+        db.create_all()
+    menu_snapshot.bump()
+
+'''
+Bring a drink table from before recipes were stored as JSON up to date with:
+    flask upgrade-recipes
+'''
+@app.cli.command('upgrade-recipes')
+def upgrade_recipes_command():
+    db_upgrade_recipes()
 
 ## ROUTES
+'''
+    GET /healthz
+        reports the database connection pool's usage and checkout waits
+    returns status code 200 and the pool state, or 503 when the database does not answer
+'''
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    health = pool_health(db.engine)
+    health['status'] = 'ok' if health['database'] == 'ok' else 'unavailable'
+    return jsonify(health), 200 if health['status'] == 'ok' else 503
+
 '''
     GET /drinks
         it should be a public endpoint
         it should contain only the drink.short() data representation
+        it is served from menu_snapshot, with an ETag, and answers a matching
+            If-None-Match with 304 Not Modified
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
 '''
 @app.route('/drinks', methods=['GET'])
 def get_drinks():
-    drinks = Drink.query.all()
-    print(drinks)
-    drink_data = []
-    for drink in drinks:
-        drink_data.append(
-            drink.short()
-        )
-    data_object = {
-        "success": True,
-        "drinks": drink_data
-    }
-    data = jsonify(data_object)
-    return data
+    body, etag = menu_snapshot.get()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients may keep the menu, but check it is current before using it
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 '''
     GET /drinks-detail
@@ -66,8 +110,8 @@ def get_drinks():
 '''
 
 @app.route('/drinks-detail', methods = ['GET'])
-@requires_auth('get:drinksdetail')
-def get_drinks_details():
+@requires_auth('get:drinks-detail')
+def get_drinks_details(payload):
     # TODO Finish drinks query
     drinks = Drink.query.all()
     drink_data = []
@@ -98,18 +142,11 @@ def create_drink():
     error = False
     try:
         drink_title = request.get_json()['title']
-        drink_recipe_json = request.get_json()['recipe']
-        drink_recipe = json.dumps(drink_recipe_json)
+        drink_recipe = request.get_json()['recipe']
         new_drink = Drink(title = drink_title, recipe = drink_recipe)
         new_drink.insert()
         # Instructions specify that response data should inclue drink details as a list
-        new_drink_details = []
-        new_drink_details_object = {
-            "id": new_drink.id,
-            "title": drink_title,
-            "recipe": drink_recipe
-        }
-        new_drink_details.append(new_drink_details_object)
+        new_drink_details = [new_drink.long()]
         response_object.update(
             {
                 "success": True,
@@ -146,18 +183,11 @@ def update_drink(drink_id):
     try:
         drink = Drink.query.get(drink_id)
         updated_drink_title = request.get_json()['title']
-        updated_drink_recipe_json = request.get_json()['recipe']
-        updated_drink_recipe = json.dumps(updated_drink_recipe_json)
+        updated_drink_recipe = request.get_json()['recipe']
         drink.title = updated_drink_title
         drink.recipe = updated_drink_recipe
         drink.update()
-        new_drink_details = []
-        new_drink_details_object = {
-            "id": drink.id,
-            "title": updated_drink_title,
-            "recipe": updated_drink_recipe
-        }
-        new_drink_details.append(new_drink_details_object)
+        new_drink_details = [drink.long()]
         response_object.update(
             {
                 "success": True,
@@ -244,4 +274,11 @@ def unprocessable(error):
 '''
 @TODO implement error handler for AuthError
     error handler should conform to general task above 
-'''
\ No newline at end of file
+'''
+@app.errorhandler(AuthError)
+def auth_error(error):
+    return jsonify({
+                    "success": False,
+                    "error": error.status_code,
+                    "message": error.error
+                    }), error.status_code
@@ -1,13 +1,30 @@
 import json
+import os
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from .jwks import JWKSError, JWKSKeyStore
+from .permissions import PermissionRequirement, permission_set
+from .token_cache import VerifiedTokenCache
 
 
 AUTH0_DOMAIN = 'dev-ju3r18pc.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'https://jackstewart.net/authentication'
+# May point to a stand-in key set, e.g. when testing
+JWKS_URL = os.environ.get('AUTH0_JWKS_URL', "https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
+
+# Auth0's signing keys, fetched once and refreshed in the background
+jwks_store = JWKSKeyStore(
+    JWKS_URL,
+    ttl=int(os.environ.get('AUTH0_JWKS_TTL', 3600)),
+    refetch_interval=int(os.environ.get('AUTH0_JWKS_REFETCH_INTERVAL', 30))
+)
+
+# Payloads and permission sets of tokens already verified, until they
+# expire; 0 turns it off
+token_cache = VerifiedTokenCache(int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 1024)))
 
 ## AuthError Exception
 '''
@@ -29,7 +46,6 @@ class AuthError(Exception):
     return the token part of the header
 '''
 def get_token_auth_header():
-    print(request.headers)
     auth_value = request.headers.get('Authorization', None)
     if auth_value:
         # Partially derived from Auth0 quick start docs (https://auth0.com/docs/quickstart/backend/python/01-authorization)
@@ -63,37 +79,43 @@ def get_token_auth_header():
                 },
                 401
             )
-            print(auth_token)
-            return auth_token
+        return auth_token
     else:
         raise AuthError('Authorization error', 401)
 
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), or a PermissionRequirement
         payload: decoded JWT payload
+        granted: optionally, the permission_set of the payload's permissions,
+            compiled when the token was verified
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
+        granted scopes may be wildcards, see permissions.py
     return true otherwise
 '''
-def check_permissions(permission, payload):
-    # TODO Add all possible permissions values to `all_permissions`
-    # all_permissions = []
-    # payload_permissions = 0
-    # for permission in all_permissions:
-    #     if permission in payload:
-    #         payload_permissions += 1
-    #     else:
-    #         pass
-    print(permission, payload)
-    if payload_permissions <= 0:
-        AuthError('Permissions not provided', 401)
-    elif permission not in payload:
-        AuthError('Unauthorized request', 401)
-    else:
-        return True
+def check_permissions(permission, payload, granted=None):
+    if 'permissions' not in payload:
+        raise AuthError({
+            "code": "invalid_claims",
+            "description": "Permissions not included in the token"
+            },
+            400
+        )
+    if not isinstance(permission, PermissionRequirement):
+        permission = PermissionRequirement([permission] if permission else [])
+    if granted is None:
+        granted = permission_set(payload['permissions'])
+    if not permission.satisfied_by(granted):
+        raise AuthError({
+            "code": "unauthorized",
+            "description": "Permission not granted"
+            },
+            403
+        )
+    return True
 
 '''
 @TODO implement verify_decode_jwt(token) method
@@ -101,19 +123,18 @@ def check_permissions(permission, payload):
         token: a json web token (string)
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the keys come from jwks_store, which fetches them only when they
+        expire or a token names a key it does not hold
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
-def verify_decode_jwt(token):
+def verify_decode_jwt(token, key_store=None):
     # References Python Quick Start: https://auth0.com/docs/quickstart/backend/python/01-authorization
-    jsonurl = urlopen("https://"+AUTH0_DOMAIN+"/.well-known/jwks.json")
-    # Store the web key set as a Python object
-    jwks = json.loads(jsonurl.read())
+    key_store = key_store or jwks_store
     try:
         unverified_header = jwt.get_unverified_header(token)
-        print(unverified_header)
     except jwt.JWTError:
         raise AuthError({
             "code": "invalid_header",
@@ -121,16 +142,22 @@ def verify_decode_jwt(token):
             },
             401
         )
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            "code": "invalid_header",
+            "description": "Authorization token has no key id"
+            },
+            401
+        )
+    try:
+        rsa_key = key_store.get_key(unverified_header['kid'])
+    except JWKSError:
+        raise AuthError({
+            "code": "jwks_unavailable",
+            "description": "Unable to fetch the keys to verify the token"
+            },
+            503
+        )
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -161,27 +188,43 @@ def verify_decode_jwt(token):
                 },
                 401
             )
-        _request_ctx_stack.top.current_user = payload
-        return f(*args, **kwargs)
-    print(payload)
-    return payload
+        return payload
+    raise AuthError({
+        "code": "invalid_header",
+        "description": "Unable to find the appropriate key"
+        },
+        401
+    )
 
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permissions: string permissions (i.e. 'post:drink'), all of which are
+            required, or with match='any' at least one
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        unless token_cache holds the payload of the same token, verified
+        earlier and not yet expired, along with its permission set
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
+    EXAMPLE
+        @requires_auth('patch:drinks', 'delete:drinks', match='any')
 '''
-def requires_auth(permission=''):
+def requires_auth(*permissions, match='all'):
+    # Expanded once here, rather than on every request
+    requirement = PermissionRequirement([permission for permission in permissions if permission], match)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            verified = token_cache.get(token)
+            if verified is None:
+                payload = verify_decode_jwt(token)
+                verified = (payload, permission_set(payload.get('permissions', ())))
+                token_cache.put(token, verified, payload.get('exp'))
+            payload, granted = verified
+            check_permissions(requirement, payload, granted)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
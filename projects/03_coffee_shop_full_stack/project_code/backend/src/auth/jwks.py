@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+'''
+JWKSError Exception
+raised when no signing keys can be fetched and none are left to fall back on
+'''
+class JWKSError(Exception):
+    pass
+
+
+'''
+JWKSKeyStore(url)
+    the signing keys of a JSON Web Key Set, fetched from url and kept by
+    their key id (kid).
+
+    Keys are served from memory. Once they are older than ttl seconds they
+    are refetched in a background thread while the current keys keep being
+    served. A kid that is not in the set, as after the issuer rotates its
+    keys, forces a refetch. Fetches are attempted at most once every
+    refetch_interval seconds, so that made-up kids or an unreachable issuer
+    cannot flood it. A failed fetch keeps the keys already held for up to
+    max_stale seconds.
+
+    fetch(url, timeout) returns the key set as a dict, and may be replaced,
+    e.g. in tests.
+'''
+class JWKSKeyStore(object):
+    def __init__(self, url, ttl=3600, refetch_interval=30, max_stale=86400, timeout=5, fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.fetch = fetch or fetch_jwks
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.last_error = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        # Held while fetching, so that concurrent requests share one fetch
+        self.fetch_lock = threading.Lock()
+
+    '''
+    get_key(kid)
+        returns the key with id kid, or None when the key set does not hold it
+        raises JWKSError when the key set cannot be fetched and no keys held
+        are fresh enough to use
+    '''
+    def get_key(self, kid):
+        if not self.usable():
+            with self.fetch_lock:
+                if not self.usable() and self.can_refetch():
+                    self._fetch()
+            if not self.usable():
+                raise JWKSError('Unable to fetch the signing keys from {}: {!r}'.format(self.url, self.last_error))
+        elif time.monotonic() - self.fetched_at >= self.ttl:
+            self.refresh_in_background()
+        key = self.keys.get(kid)
+        if key is None:
+            with self.fetch_lock:
+                # The issuer may have rotated its keys since they were fetched
+                key = self.keys.get(kid)
+                if key is None and self.can_refetch():
+                    self._fetch()
+                    key = self.keys.get(kid)
+        return key
+
+    def usable(self):
+        return self.fetched_at is not None and time.monotonic() - self.fetched_at < self.max_stale
+
+    def can_refetch(self):
+        return self.attempted_at is None or time.monotonic() - self.attempted_at >= self.refetch_interval
+
+    '''
+    refresh()
+        fetches the key set and replaces the keys held, or keeps them and
+        records the error when the fetch fails
+    returns True when the keys were replaced
+    '''
+    def refresh(self):
+        with self.fetch_lock:
+            return self._fetch()
+
+    def _fetch(self):
+        self.attempted_at = time.monotonic()
+        try:
+            jwks = self.fetch(self.url, self.timeout)
+            keys = dict((key['kid'], key) for key in jwks['keys'] if 'kid' in key)
+        except Exception as e:
+            self.last_error = e
+            print('JWKS fetch from {} failed: {!r}'.format(self.url, e))
+            return False
+        with self.lock:
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+            self.last_error = None
+        return True
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing or not self.can_refetch():
+                return
+            self.refreshing = True
+        thread = threading.Thread(target=self._background_refresh, name='jwks-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+
+def fetch_jwks(url, timeout):
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
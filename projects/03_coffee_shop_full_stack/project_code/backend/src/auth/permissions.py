@@ -0,0 +1,67 @@
+'''
+Permission checks against a token's permissions claim.
+
+A token's permissions are turned into a frozenset once, when the token is
+verified, and kept with it in the token cache. Permissions are scopes of
+':'-separated segments such as 'post:drinks'. A granted scope may use '*'
+for any one segment, as in '*:drinks', or end with '*' to cover everything
+below it, as in 'patch:*' or '*'.
+
+Each required permission is expanded ahead of time into every scope that
+would grant it. A check then looks those scopes up in the token's set,
+which costs the same however many permissions the token carries.
+'''
+from itertools import product
+
+WILDCARD = '*'
+SEPARATOR = ':'
+
+
+'''
+permission_set(permissions)
+    returns the frozenset of a permissions claim, a list of scopes or a
+    space-separated string of them
+'''
+def permission_set(permissions):
+    if isinstance(permissions, str):
+        permissions = permissions.split()
+    return frozenset(permissions)
+
+
+'''
+granting_scopes(permission)
+    returns the frozenset of scopes any one of which grants permission
+'''
+def granting_scopes(permission):
+    segments = permission.split(SEPARATOR)
+    scopes = set()
+    # '*' in place of any of the segments
+    for choices in product(*[(segment, WILDCARD) for segment in segments]):
+        scopes.add(SEPARATOR.join(choices))
+    # A trailing '*' covering the segments after a prefix
+    for length in range(len(segments)):
+        scopes.add(SEPARATOR.join(segments[:length] + [WILDCARD]))
+    return frozenset(scopes)
+
+
+'''
+PermissionRequirement(permissions, match='all')
+    the permissions a route requires, all of them or, with match='any', at
+    least one. No permissions at all are always satisfied.
+'''
+class PermissionRequirement(object):
+    def __init__(self, permissions, match='all'):
+        if match not in ('all', 'any'):
+            raise ValueError("match must be 'all' or 'any', not {!r}".format(match))
+        self.permissions = tuple(permissions)
+        self.match = match
+        self.grants = tuple(granting_scopes(permission) for permission in self.permissions)
+
+    def satisfied_by(self, granted):
+        if not self.grants:
+            return True
+        test = all if self.match == 'all' else any
+        return test(not scopes.isdisjoint(granted) for scopes in self.grants)
+
+    def __repr__(self):
+        return 'PermissionRequirement({!r}, match={!r})'.format(self.permissions, self.match)
@@ -0,0 +1,76 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+VerifiedTokenCache(max_size=1024)
+    what was learned from tokens that passed verification, such as their
+    decoded payloads, so that a token sent again is not parsed and RSA
+    verified again.
+
+    Entries are keyed by the SHA-256 digest of the token rather than the
+    token itself, and expire at the time given for them, the token's exp
+    claim. Tokens without one are not cached. At most max_size entries are
+    kept, dropping the least recently used; a max_size of 0 turns the cache
+    off.
+'''
+class VerifiedTokenCache(object):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    '''
+    get(token)
+        returns the cached value of token, or None when it is not cached or
+        has expired
+    '''
+    def get(self, token):
+        if not self.max_size:
+            return None
+        digest = token_digest(token)
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self.entries[digest]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return value
+
+    '''
+    put(token, value, expires_at)
+        caches value for token until expires_at, in seconds since the epoch
+    '''
+    def put(self, token, value, expires_at):
+        if not self.max_size:
+            return
+        try:
+            expires_at = float(expires_at)
+        except (TypeError, ValueError):
+            return
+        digest = token_digest(token)
+        with self.lock:
+            self.entries[digest] = (value, expires_at)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8') if isinstance(token, str) else token).digest()
@@ -1,22 +1,28 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import Column, String, Integer, Text, JSON, inspect, text
+from sqlalchemy.orm import validates
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from .pool import engine_options
+
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
-database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filename))
+database_path = os.environ.get('DATABASE_URL', "sqlite:///{}".format(os.path.join(project_dir, database_filename)))
 
 db = SQLAlchemy()
 session_secret_key = os.urandom(24)
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the pool
+    settings of the app's config
+    it does not create the tables, see db_drop_and_create_all()
 '''
-def setup_db(app):
+def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config, database_path)
     app.config["SECRET_KEY"] = session_secret_key
     db.app = app
     db.init_app(app)
@@ -31,6 +37,28 @@ def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+'''
+db_upgrade_recipes()
+    adds the recipe_short column to a drink table created before it existed,
+    and fills in the short form of every recipe
+    can be run more than once
+'''
+def db_upgrade_recipes():
+    columns = [column['name'] for column in inspect(db.engine).get_columns(Drink.__tablename__)]
+    if 'recipe_short' not in columns:
+        db.session.execute(text('ALTER TABLE {} ADD COLUMN recipe_short TEXT'.format(Drink.__tablename__)))
+    for drink in Drink.query.all():
+        # Assigning the recipe again computes its short form
+        drink.recipe = json.loads(drink.recipe) if isinstance(drink.recipe, str) else drink.recipe
+    db.session.commit()
+
+'''
+short_recipe(recipe)
+    the short form of a recipe, the color and parts of each ingredient
+'''
+def short_recipe(recipe):
+    return [{'color': r['color'], 'parts': r['parts']} for r in recipe]
+
 '''
 Drink
 a persistent drink entity, extends the base SQLAlchemy Model
@@ -40,23 +68,54 @@ class Drink(db.Model):
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
     # String Title
     title = Column(String(80), unique=True)
-    # the ingredients blob - this stores a lazy json blob
+    # the ingredients, stored as JSON and read back as a list
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
-    recipe = Column(String(180), nullable=False)
+    recipe = Column(JSON, nullable=False)
+    # the short form of the recipe, serialized when the recipe is set, so that
+    # listings can include it without decoding anything
+    recipe_short = Column(Text, nullable=False)
+
+    '''
+    recipe validation
+        checks each ingredient when the recipe is set, and stores its short form
+        raises ValueError for a recipe that is not a list of ingredients
+    '''
+    @validates('recipe')
+    def validate_recipe(self, key, recipe):
+        if isinstance(recipe, dict):
+            recipe = [recipe]
+        if not isinstance(recipe, list):
+            raise ValueError('recipe must be a list of ingredients')
+        for ingredient in recipe:
+            if not isinstance(ingredient, dict) or not all(field in ingredient for field in ('name', 'color', 'parts')):
+                raise ValueError('each ingredient needs a name, color and parts')
+        self.recipe_short = json.dumps(short_recipe(recipe))
+        return recipe
 
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': short_recipe(self.recipe)
         }
 
+    '''
+    short_listing()
+        the short form of every drink as a JSON array, put together from the
+        stored recipe_short text, so that no recipe is decoded
+    '''
+    @classmethod
+    def short_listing(cls):
+        rows = db.session.query(cls.id, cls.title, cls.recipe_short).order_by(cls.id)
+        return '[' + ', '.join(
+            '{{"id": {}, "title": {}, "recipe": {}}}'.format(id, json.dumps(title), recipe_short)
+            for id, title, recipe_short in rows
+        ) + ']'
+
     '''
     long()
         long form representation of the Drink model
@@ -65,7 +124,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.recipe
         }
 
     '''
@@ -0,0 +1,231 @@
+import glob
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, object_session
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, so processes there update the counter unlocked
+    fcntl = None
+
+VERSION = struct.Struct('<Q')
+
+'''
+SharedSnapshot(name, build, directory, fingerprint, check_interval)
+    a response body built by build() and kept in memory as bytes, with its
+    ETag, until the version counter is bumped.
+
+    The counter lives in a small file under directory that every worker
+    process maps into memory, so checking it costs no system call. Bumping
+    it takes a file lock. A snapshot is also written to directory under
+    its version, so that the first worker to need a new version builds it
+    and the others read the same bytes instead of querying the database.
+
+    Changes made without committing through this app, such as by another
+    program, are caught by fingerprint(), a description of the database's
+    state stored with each snapshot. It is checked at most every
+    check_interval seconds, and the version is bumped when it has changed.
+'''
+class SharedSnapshot(object):
+    def __init__(self, name, build, directory, fingerprint=None, check_interval=1.0):
+        self.name = name
+        self.build = build
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.check_interval = check_interval
+        self.version = None
+        self.body = None
+        self.etag = None
+        self.built_from = None
+        self.next_check = 0
+        self.counter = None
+        self.lock = threading.Lock()
+        # A forked worker maps the counter itself, since file locks taken
+        # through an inherited descriptor would not exclude the parent
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.forget_counter)
+
+    def forget_counter(self):
+        if self.counter is not None:
+            os.close(self.counter[0])
+        self.counter = None
+        self.lock = threading.Lock()
+
+    def open_counter(self):
+        # The counter file holds the version as 8 bytes, zero until first bumped
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, self.name + '.version'), os.O_RDWR | os.O_CREAT, 0o644)
+        with file_lock(fd):
+            if os.fstat(fd).st_size < VERSION.size:
+                os.write(fd, bytes(VERSION.size))
+        self.counter = (fd, mmap.mmap(fd, VERSION.size))
+
+    def current_version(self):
+        if self.counter is None:
+            with self.lock:
+                if self.counter is None:
+                    self.open_counter()
+        return VERSION.unpack_from(self.counter[1])[0]
+
+    @contextmanager
+    def locked_counter(self):
+        self.current_version()
+        fd, counter = self.counter
+        with file_lock(fd):
+            yield counter
+
+    '''
+    bump()
+        moves every process on to a new version, built on its next get()
+    returns the new version
+    '''
+    def bump(self):
+        with self.locked_counter() as counter:
+            version = VERSION.unpack_from(counter)[0] + 1
+            VERSION.pack_into(counter, 0, version)
+        return version
+
+    '''
+    get()
+        returns the body of the current version and its ETag
+    '''
+    def get(self):
+        version = self.current_version()
+        if version == self.version and self.fingerprint is not None and time.monotonic() >= self.next_check:
+            self.next_check = time.monotonic() + self.check_interval
+            if self.fingerprint() != self.built_from:
+                version = self.bump()
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.load(version)
+        return self.body, self.etag
+
+    def snapshot_path(self, version):
+        return os.path.join(self.directory, '{}.{}.snapshot'.format(self.name, version))
+
+    def load(self, version):
+        # A snapshot file holds the fingerprint it was built from on its
+        # first line, followed by the body
+        try:
+            with open(self.snapshot_path(version), 'rb') as file:
+                built_from, body = file.read().split(b'\n', 1)
+            built_from = built_from.decode('utf-8')
+        except FileNotFoundError:
+            # Built after reading the version and the fingerprint, so the
+            # body is at least as new as both
+            built_from = self.fingerprint() if self.fingerprint is not None else ''
+            body = self.build()
+            self.write(version, built_from.encode('utf-8') + b'\n' + body)
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()
+        self.built_from = built_from
+        self.next_check = time.monotonic() + self.check_interval
+        self.version = version
+
+    def write(self, version, contents):
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=self.name + '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(contents)
+        os.replace(temporary_path, self.snapshot_path(version))
+        # Older versions are no longer served
+        for path in glob.glob(os.path.join(self.directory, self.name + '.*.snapshot')):
+            if path != self.snapshot_path(version) and self.path_version(path) < version:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def path_version(self, path):
+        try:
+            return int(os.path.basename(path)[len(self.name) + 1:-len('.snapshot')])
+        except ValueError:
+            return -1
+
+    '''
+    bump_on_commit(model)
+        bumps the version once a session that inserted, changed or deleted
+        rows of model commits, so that other processes never build a
+        snapshot from data that is not committed yet
+    '''
+    def bump_on_commit(self, model):
+        key = 'snapshot.' + self.name
+
+        def mark_changed(mapper, connection, target):
+            session = object_session(target)
+            if session is not None:
+                session.info[key] = True
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, mark_changed)
+
+        @event.listens_for(Session, 'after_commit')
+        def bump_after_commit(session):
+            if session.info.pop(key, False):
+                self.bump()
+
+        @event.listens_for(Session, 'after_rollback')
+        def forget_changes(session):
+            session.info.pop(key, None)
+
+
+@contextmanager
+def file_lock(fd):
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+'''
+database_fingerprint(database_path, max_age)
+    a fingerprint() for SharedSnapshot that changes whenever a SQLite
+    database file, or its write-ahead log, is written to. A server database
+    has no file to check, so its fingerprint changes every max_age seconds
+    instead. An in-memory database is only changed by this process, so it
+    needs none, and None is returned.
+'''
+def database_fingerprint(database_path, max_age=60):
+    url = make_url(database_path)
+    if url.get_backend_name() != 'sqlite':
+        return lambda: str(int(time.time() // max_age))
+    if url.database in (None, '', ':memory:'):
+        return None
+    paths = (url.database, url.database + '-wal')
+
+    def fingerprint():
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stats.append('{}:{}'.format(stat.st_mtime_ns, stat.st_size))
+        return ' '.join(stats)
+    return fingerprint
+
+
+'''
+snapshot_directory(database_path)
+    the directory shared by the processes serving database_path, or one of
+    this process's own for an in-memory database
+'''
+def snapshot_directory(database_path):
+    if database_path in ('sqlite://', 'sqlite:///:memory:'):
+        return tempfile.mkdtemp(prefix='coffee-shop-')
+    digest = hashlib.sha256(database_path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'coffee-shop-' + digest)
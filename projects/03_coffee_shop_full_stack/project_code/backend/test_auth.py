@@ -0,0 +1,288 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import rsa
+from flask import Flask, jsonify
+from jose import jwk, jwt
+
+from src.auth import auth
+from src.auth.auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN, AuthError, check_permissions, requires_auth, verify_decode_jwt
+from src.auth.jwks import JWKSError, JWKSKeyStore, fetch_jwks
+from src.auth.permissions import PermissionRequirement, permission_set
+from src.auth.token_cache import VerifiedTokenCache
+
+
+class JWKSServer(HTTPServer):
+    """A local stand-in for Auth0's /.well-known/jwks.json"""
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), JWKSHandler)
+        self.keys = []
+        self.failing = False
+        self.requests = 0
+        self.url = 'http://127.0.0.1:{}/.well-known/jwks.json'.format(self.server_port)
+
+
+class JWKSHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.failing:
+            self.send_error(500)
+            return
+        body = json.dumps({'keys': self.server.keys}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def signing_key(kid):
+    # Returns a private key in PEM form and the JWK of its public key
+    public_key, private_key = rsa.newkeys(1024)
+    public_jwk = jwk.construct(public_key.save_pkcs1().decode('utf-8'), ALGORITHMS[0]).to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return private_key.save_pkcs1().decode('utf-8'), public_jwk
+
+
+def sign_token(private_key, kid='first-key', expires_in=3600, permissions=('get:drinks-detail',)):
+    claims = {
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'aud': API_AUDIENCE,
+        'sub': 'auth0|barista',
+        'exp': int(time.time()) + expires_in,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private_key, algorithm=ALGORITHMS[0], headers={'kid': kid})
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key cache test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key, cls.public_jwk = signing_key('first-key')
+        cls.rotated_private_key, cls.rotated_public_jwk = signing_key('rotated-key')
+
+    def setUp(self):
+        self.server = JWKSServer()
+        self.server.keys = [self.public_jwk]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def token(self, private_key=None, kid='first-key'):
+        return sign_token(private_key or self.private_key, kid)
+
+    def test_verify_fetches_keys_once(self):
+        store = JWKSKeyStore(self.server.url)
+        for _ in range(3):
+            payload = verify_decode_jwt(self.token(), store)
+            self.assertEqual(payload['sub'], 'auth0|barista')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_unknown_kid_refetches(self):
+        store = JWKSKeyStore(self.server.url, refetch_interval=0)
+        verify_decode_jwt(self.token(), store)
+        self.server.keys = [self.public_jwk, self.rotated_public_jwk]
+
+        payload = verify_decode_jwt(self.token(self.rotated_private_key, 'rotated-key'), store)
+        self.assertEqual(payload['sub'], 'auth0|barista')
+        self.assertEqual(self.server.requests, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = JWKSKeyStore(self.server.url, refetch_interval=60)
+        verify_decode_jwt(self.token(), store)
+        for _ in range(3):
+            with self.assertRaises(AuthError) as raised:
+                verify_decode_jwt(self.token(kid='made-up-key'), store)
+            self.assertEqual(raised.exception.status_code, 401)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_expired_keys_refresh_in_background(self):
+        released = threading.Event()
+
+        def held_fetch(url, timeout):
+            # Holds refreshes until released, after the first fetch
+            if store.fetched_at is not None:
+                released.wait(5)
+            return fetch_jwks(url, timeout)
+
+        store = JWKSKeyStore(self.server.url, ttl=0, refetch_interval=0, fetch=held_fetch)
+        self.assertEqual(store.get_key('first-key'), self.public_jwk)
+        self.server.keys = [self.rotated_public_jwk]
+
+        # The expired keys are still served while the refresh runs
+        self.assertEqual(store.get_key('first-key'), self.public_jwk)
+        self.assertTrue(store.refreshing)
+        released.set()
+        for _ in range(100):
+            if store.keys.get('rotated-key'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(store.keys, {'rotated-key': self.rotated_public_jwk})
+
+    def test_failed_refresh_keeps_stale_keys(self):
+        store = JWKSKeyStore(self.server.url, ttl=0, refetch_interval=0)
+        verify_decode_jwt(self.token(), store)
+        self.server.failing = True
+
+        self.assertFalse(store.refresh())
+        payload = verify_decode_jwt(self.token(), store)
+        self.assertEqual(payload['sub'], 'auth0|barista')
+        self.assertIsNotNone(store.last_error)
+
+    def test_unavailable_key_set(self):
+        self.server.failing = True
+        store = JWKSKeyStore(self.server.url)
+        with self.assertRaises(JWKSError):
+            store.get_key('first-key')
+        with self.assertRaises(AuthError) as raised:
+            verify_decode_jwt(self.token(), store)
+        self.assertEqual(raised.exception.status_code, 503)
+        # Retried only once the refetch interval has passed
+        self.assertEqual(self.server.requests, 1)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified-token cache test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key, cls.public_jwk = signing_key('first-key')
+
+    def setUp(self):
+        self.jwks_store = auth.jwks_store
+        self.token_cache = auth.token_cache
+        auth.jwks_store = JWKSKeyStore('http://jwks.invalid/', fetch=lambda url, timeout: {'keys': [self.public_jwk]})
+        auth.token_cache = VerifiedTokenCache(16)
+        self.app = Flask(__name__)
+
+        @self.app.route('/drinks-detail')
+        @requires_auth('get:drinks-detail')
+        def drinks_detail(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @self.app.route('/drinks/manage')
+        @requires_auth('patch:drinks', 'delete:drinks', match='any')
+        def manage_drinks(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @self.app.errorhandler(AuthError)
+        def auth_error(error):
+            return jsonify({'error': error.status_code}), error.status_code
+
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        auth.jwks_store = self.jwks_store
+        auth.token_cache = self.token_cache
+
+    def get(self, token, path='/drinks-detail'):
+        return self.client().get(path, headers={'Authorization': 'Bearer ' + token})
+
+    def test_cached_token_skips_verification(self):
+        token = sign_token(self.private_key)
+        self.assertEqual(self.get(token).status_code, 200)
+        # Without the signing key, only a cached payload can pass
+        auth.jwks_store = JWKSKeyStore('http://jwks.invalid/', fetch=lambda url, timeout: {'keys': []})
+        res = self.get(token)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['sub'], 'auth0|barista')
+        self.assertEqual(auth.token_cache.hits, 1)
+
+    def test_cached_token_still_checks_permissions(self):
+        token = sign_token(self.private_key, permissions=['post:drinks'])
+        for _ in range(2):
+            self.assertEqual(self.get(token).status_code, 403)
+        self.assertEqual(auth.token_cache.hits, 1)
+
+    def test_requires_any_permission(self):
+        token = sign_token(self.private_key, permissions=['delete:drinks'])
+        self.assertEqual(self.get(token, '/drinks/manage').status_code, 200)
+        token = sign_token(self.private_key, permissions=['get:drinks-detail'])
+        self.assertEqual(self.get(token, '/drinks/manage').status_code, 403)
+
+    def test_invalid_token_is_not_cached(self):
+        _, other_jwk = signing_key('first-key')
+        auth.jwks_store = JWKSKeyStore('http://jwks.invalid/', fetch=lambda url, timeout: {'keys': [other_jwk]})
+        self.assertEqual(self.get(sign_token(self.private_key)).status_code, 401)
+        self.assertEqual(len(auth.token_cache), 0)
+
+    def test_entries_expire_with_the_token(self):
+        cache = VerifiedTokenCache(16)
+        cache.put('expired', 'payload', time.time() - 1)
+        cache.put('no expiry', 'payload', None)
+        cache.put('valid', 'payload', time.time() + 60)
+        self.assertIsNone(cache.get('expired'))
+        self.assertIsNone(cache.get('no expiry'))
+        self.assertIsNotNone(cache.get('valid'))
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_entries_are_dropped(self):
+        cache = VerifiedTokenCache(2)
+        for token in ('first', 'second'):
+            cache.put(token, 'payload', time.time() + 60)
+        cache.get('first')
+        cache.put('third', 'payload', time.time() + 60)
+        self.assertIsNotNone(cache.get('first'))
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('third'))
+
+    def test_disabled_cache(self):
+        cache = VerifiedTokenCache(0)
+        cache.put('token', 'payload', time.time() + 60)
+        self.assertIsNone(cache.get('token'))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the permission check test case"""
+
+    def test_exact_permissions(self):
+        granted = permission_set(['get:drinks-detail', 'post:drinks'])
+        self.assertTrue(PermissionRequirement(['post:drinks']).satisfied_by(granted))
+        self.assertFalse(PermissionRequirement(['patch:drinks']).satisfied_by(granted))
+        self.assertFalse(PermissionRequirement(['post']).satisfied_by(granted))
+
+    def test_wildcard_permissions(self):
+        requirement = PermissionRequirement(['patch:drinks'])
+        for scope in ('*', '*:drinks', 'patch:*', '*:*'):
+            self.assertTrue(requirement.satisfied_by(permission_set([scope])), scope)
+        for scope in ('*:drinks-detail', 'get:*', 'patch:drinks:*'):
+            self.assertFalse(requirement.satisfied_by(permission_set([scope])), scope)
+        # A trailing '*' covers every level below it
+        self.assertTrue(PermissionRequirement(['drinks:recipes:write']).satisfied_by(permission_set(['drinks:*'])))
+
+    def test_all_and_any(self):
+        granted = permission_set('get:drinks-detail patch:drinks')
+        self.assertTrue(PermissionRequirement(['get:drinks-detail', 'patch:drinks']).satisfied_by(granted))
+        self.assertFalse(PermissionRequirement(['patch:drinks', 'delete:drinks']).satisfied_by(granted))
+        self.assertTrue(PermissionRequirement(['patch:drinks', 'delete:drinks'], match='any').satisfied_by(granted))
+        self.assertTrue(PermissionRequirement([]).satisfied_by(frozenset()))
+        with self.assertRaises(ValueError):
+            PermissionRequirement(['patch:drinks'], match='some')
+
+    def test_check_permissions(self):
+        payload = {'permissions': ['*:drinks']}
+        self.assertTrue(check_permissions('post:drinks', payload))
+        with self.assertRaises(AuthError) as raised:
+            check_permissions('get:drinks-detail', payload)
+        self.assertEqual(raised.exception.status_code, 403)
+        with self.assertRaises(AuthError) as raised:
+            check_permissions('post:drinks', {'sub': 'auth0|barista'})
+        self.assertEqual(raised.exception.status_code, 400)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+# Never the database DATABASE_URL names, since the tests drop every table
+os.environ['DATABASE_URL'] = os.environ.get('COFFEE_SHOP_TEST_DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import text
+
+from src.api import app, menu_snapshot
+from src.database.models import db, db_upgrade_recipes, Drink
+from src.database.snapshot import SharedSnapshot, database_fingerprint
+
+LATTE = [{'name': 'espresso', 'color': 'brown', 'parts': 1}, {'name': 'milk', 'color': 'white', 'parts': 3}]
+
+
+class DrinksTestCase(unittest.TestCase):
+    """This class represents the drink storage test case"""
+
+    def setUp(self):
+        self.client = app.test_client
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        # Dropping the tables is not a change to any drink
+        menu_snapshot.bump()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_short_form_is_stored_with_the_recipe(self):
+        drink = Drink(title='Latte', recipe=LATTE)
+        drink.insert()
+        self.assertEqual(json.loads(drink.recipe_short), [{'color': 'brown', 'parts': 1}, {'color': 'white', 'parts': 3}])
+
+        drink.recipe = LATTE[:1]
+        drink.update()
+        self.assertEqual(json.loads(drink.recipe_short), [{'color': 'brown', 'parts': 1}])
+
+    def test_get_drinks_matches_short_form(self):
+        drinks = [Drink(title='Latte', recipe=LATTE), Drink(title='Say "espresso"', recipe=LATTE[:1])]
+        for drink in drinks:
+            drink.insert()
+
+        res = self.client().get('/drinks')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['drinks'], [drink.short() for drink in drinks])
+
+    def test_get_drinks_not_modified(self):
+        Drink(title='Latte', recipe=LATTE).insert()
+        res = self.client().get('/drinks')
+        etag = res.headers['ETag']
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+
+        res = self.client().get('/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_drink_changes_bump_the_menu(self):
+        res = self.client().get('/drinks')
+        etag = res.headers['ETag']
+        version = menu_snapshot.current_version()
+
+        res = self.client().post('/drinks', json={'title': 'Latte', 'recipe': LATTE})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(menu_snapshot.current_version(), version + 1)
+        res = self.client().get('/drinks', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([drink['title'] for drink in json.loads(res.data)['drinks']], ['Latte'])
+
+        drink_id = json.loads(res.data)['drinks'][0]['id']
+        self.client().patch('/drinks/{}'.format(drink_id), json={'title': 'Flat white', 'recipe': LATTE})
+        res = self.client().get('/drinks')
+        self.assertEqual([drink['title'] for drink in json.loads(res.data)['drinks']], ['Flat white'])
+
+        self.client().delete('/drinks/{}'.format(drink_id))
+        res = self.client().get('/drinks')
+        self.assertEqual(json.loads(res.data)['drinks'], [])
+
+    def test_failed_change_does_not_bump_the_menu(self):
+        Drink(title='Latte', recipe=LATTE).insert()
+        version = menu_snapshot.current_version()
+        res = self.client().post('/drinks', json={'title': 'Latte', 'recipe': LATTE})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(menu_snapshot.current_version(), version)
+
+    def test_long_form(self):
+        drink = Drink(title='Latte', recipe=LATTE)
+        drink.insert()
+        db.session.expire_all()
+        self.assertEqual(Drink.query.get(drink.id).long()['recipe'], LATTE)
+
+    def test_invalid_recipes(self):
+        for recipe in ('espresso', [{'name': 'espresso'}], ['espresso']):
+            with self.assertRaises(ValueError):
+                Drink(title='Invalid', recipe=recipe)
+        # A single ingredient is taken as a recipe of one
+        self.assertEqual(Drink(title='Espresso', recipe=LATTE[0]).recipe, LATTE[:1])
+
+    def test_upgrade_recipes(self):
+        db.drop_all()
+        db.session.execute(text(
+            'CREATE TABLE drink (id INTEGER NOT NULL, title VARCHAR(80), recipe VARCHAR(180) NOT NULL, '
+            'PRIMARY KEY (id), UNIQUE (title))'
+        ))
+        db.session.execute(text('INSERT INTO drink (title, recipe) VALUES (:title, :recipe)'), {
+            'title': 'Latte',
+            'recipe': json.dumps(LATTE)
+        })
+        db.session.commit()
+
+        db_upgrade_recipes()
+        db_upgrade_recipes()
+        self.assertEqual(json.loads(Drink.short_listing()), [Drink.query.one().short()])
+
+
+class SharedSnapshotTestCase(unittest.TestCase):
+    """This class represents the shared snapshot test case"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.builds = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def snapshot(self, fingerprint=None):
+        def build():
+            self.builds.append(len(self.builds))
+            return json.dumps({'build': len(self.builds)}).encode('utf-8')
+        return SharedSnapshot('menu', build, self.directory.name, fingerprint, check_interval=0)
+
+    def test_built_once_per_version(self):
+        snapshot = self.snapshot()
+        body, etag = snapshot.get()
+        self.assertEqual(snapshot.get(), (body, etag))
+        self.assertEqual(len(self.builds), 1)
+
+        snapshot.bump()
+        self.assertNotEqual(snapshot.get()[1], etag)
+        self.assertEqual(len(self.builds), 2)
+
+    def test_shared_between_processes(self):
+        first, second = self.snapshot(), self.snapshot()
+        body, etag = first.get()
+        # The second reads what the first built, rather than building it again
+        self.assertEqual(second.get(), (body, etag))
+        self.assertEqual(len(self.builds), 1)
+
+        process = multiprocessing.get_context('fork').Process(target=first.bump)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(first.current_version(), 1)
+        self.assertEqual(second.current_version(), 1)
+        self.assertNotEqual(second.get()[1], etag)
+        self.assertEqual(first.get(), second.get())
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(os.listdir(self.directory.name).count('menu.0.snapshot'), 0)
+
+    def test_rebuilt_when_the_fingerprint_changes(self):
+        state = ['before']
+        first, second = self.snapshot(lambda: state[0]), self.snapshot(lambda: state[0])
+        body, etag = first.get()
+        self.assertEqual(second.get(), (body, etag))
+
+        # As when another program changes the database
+        state[0] = 'after'
+        self.assertNotEqual(second.get()[1], etag)
+        self.assertEqual(first.get(), second.get())
+        self.assertEqual(len(self.builds), 2)
+
+    def test_database_fingerprint(self):
+        path = os.path.join(self.directory.name, 'database.db')
+        fingerprint = database_fingerprint('sqlite:///' + path)
+        before = fingerprint()
+        with open(path, 'wb') as file:
+            file.write(b'changed')
+        self.assertNotEqual(fingerprint(), before)
+        self.assertIsNone(database_fingerprint('sqlite://'))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,34 @@
 import os
-from flask import Flask
-from models import setup_db
+from flask import Flask, jsonify
+from flask_cors import CORS
+from models import db, setup_db
+from pool import pool_health
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    # Database pool settings such as DB_POOL_SIZE, from the environment on Heroku
+    for key in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT', 'DB_POOL_RECYCLE', 'DB_STATEMENT_TIMEOUT'):
+        if key in os.environ:
+            app.config[key] = int(os.environ[key])
+    # Like EXCITED, a flag is on when set to 'true'
+    if 'DB_POOL_PRE_PING' in os.environ:
+        app.config['DB_POOL_PRE_PING'] = os.environ['DB_POOL_PRE_PING'].lower() == 'true'
+    app.config.update(test_config or {})
     setup_db(app)
     CORS(app)
 
+    @app.cli.command('create-tables')
+    def create_tables_command():
+        db.create_all()
+
+    @app.route('/healthz')
+    def healthz():
+        # Pool usage and checkout waits, and whether the database answers
+        health = pool_health(db.engine)
+        health['status'] = 'ok' if health['database'] == 'ok' else 'unavailable'
+        return jsonify(health), 200 if health['status'] == 'ok' else 503
+
     @app.route('/')
     def get_greeting():
         excited = os.environ['EXCITED']
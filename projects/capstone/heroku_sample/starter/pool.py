@@ -0,0 +1,119 @@
+'''
+Database connection pool settings and health.
+
+setup_db passes the DB_POOL_* and DB_STATEMENT_TIMEOUT settings of the app's
+config to the engine through engine_options. The pool it builds records how
+long each checkout waited for a connection and how many timed out, which
+pool_health reports together with how many of the pool's connections are
+in use. SQLite databases keep Flask-SQLAlchemy's own pool choice, since a
+queue of connections does not apply to them.
+'''
+import threading
+import time
+
+from sqlalchemy import exc, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+POOL_DEFAULTS = {
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    # Seconds to wait for a connection before giving up
+    'DB_POOL_TIMEOUT': 30,
+    # Seconds after which connections are replaced, before servers drop them
+    'DB_POOL_RECYCLE': 1800,
+    'DB_POOL_PRE_PING': True,
+    # Milliseconds a statement may run for, on PostgreSQL; None for no limit
+    'DB_STATEMENT_TIMEOUT': None,
+}
+
+
+class MonitoredQueuePool(QueuePool):
+    '''
+    QueuePool counting checkouts, the time they waited and the timeouts
+    '''
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kwargs):
+        super(MonitoredQueuePool, self).__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kwargs)
+        self.capacity = pool_size + max_overflow if max_overflow >= 0 else None
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super(MonitoredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started_at
+            with self.lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+def engine_options(config, database_path):
+    '''
+    Returns the SQLAlchemy engine options for database_path from the DB_POOL_*
+    and DB_STATEMENT_TIMEOUT settings of config
+    '''
+    settings = dict((key, config.get(key, default)) for key, default in POOL_DEFAULTS.items())
+    url = make_url(database_path)
+    if url.drivername.startswith('sqlite'):
+        return {}
+    options = {
+        'poolclass': MonitoredQueuePool,
+        'pool_size': settings['DB_POOL_SIZE'],
+        'max_overflow': settings['DB_MAX_OVERFLOW'],
+        'pool_timeout': settings['DB_POOL_TIMEOUT'],
+        'pool_recycle': settings['DB_POOL_RECYCLE'],
+        'pool_pre_ping': settings['DB_POOL_PRE_PING'],
+    }
+    if settings['DB_STATEMENT_TIMEOUT'] and url.drivername.startswith('postgres'):
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(int(settings['DB_STATEMENT_TIMEOUT']))}
+    return options
+
+
+def pool_health(engine):
+    '''
+    Returns the state of engine's pool and whether the database answers
+    '''
+    # Ping first, so that the pool figures include its checkout
+    error = None
+    started_at = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        database = 'ok'
+    except exc.SQLAlchemyError as e:
+        database = 'unavailable'
+        error = e.__class__.__name__
+    ping_seconds = time.perf_counter() - started_at
+    pool = engine.pool
+    health = {'database': database, 'ping_seconds': ping_seconds, 'pool': type(pool).__name__}
+    if error:
+        health['error'] = error
+    if isinstance(pool, QueuePool):
+        checked_out = pool.checkedout()
+        health.update({
+            'size': pool.size(),
+            'checked_out': checked_out,
+            'overflow': max(pool.overflow(), 0),
+        })
+    if isinstance(pool, MonitoredQueuePool):
+        with pool.lock:
+            health.update({
+                'capacity': pool.capacity,
+                'saturation': checked_out / pool.capacity if pool.capacity else None,
+                'checkouts': pool.checkouts,
+                'checkout_timeouts': pool.timeouts,
+                'checkout_wait_seconds': pool.wait_seconds,
+                'checkout_wait_max_seconds': pool.max_wait_seconds,
+                'checkout_wait_mean_seconds': pool.wait_seconds / pool.checkouts if pool.checkouts else 0.0,
+            })
+    return health